@@ -0,0 +1,119 @@
+"""Psychometric item statistics over a participants x items response matrix.
+
+Missing answers are NaN. Reliability and item-total statistics use the
+participants who answered every item of the scale (listwise deletion);
+item means, difficulty and missingness use every available answer.
+"""
+import warnings
+
+import numpy as np
+
+
+def to_json_values(values):
+  return [None if not np.isfinite(value) else round(float(value), 6) for value in np.asarray(values, dtype=float)]
+
+
+def to_json_value(value):
+  if value is None or not np.isfinite(value):
+    return None
+  return round(float(value), 6)
+
+
+def complete_rows(matrix):
+  return matrix[~np.isnan(matrix).any(axis=1)]
+
+
+def cronbach_alpha(matrix):
+  data = complete_rows(matrix)
+  count, items = data.shape
+  if items < 2 or count < 2:
+    return np.nan
+  item_variance = data.var(axis=0, ddof=1).sum()
+  total_variance = data.sum(axis=1).var(ddof=1)
+  if total_variance == 0:
+    return np.nan
+  return items / (items - 1) * (1 - item_variance / total_variance)
+
+
+def alpha_if_item_deleted(matrix):
+  data = complete_rows(matrix)
+  count, items = data.shape
+  if items < 3 or count < 2:
+    return np.full(items, np.nan)
+  covariance = np.cov(data, rowvar=False)
+  variances = np.diag(covariance)
+  # 去掉第 i 题后总分方差 = 全部协方差之和 - 2 * 第 i 行之和 + 第 i 题方差
+  total_without = covariance.sum() - 2 * covariance.sum(axis=1) + variances
+  item_without = variances.sum() - variances
+  with np.errstate(divide='ignore', invalid='ignore'):
+    alpha = (items - 1) / (items - 2) * (1 - item_without / total_without)
+  alpha[total_without == 0] = np.nan
+  return alpha
+
+
+def corrected_item_total_correlations(matrix):
+  """Correlation of each item with the sum of the other items."""
+  data = complete_rows(matrix)
+  count, items = data.shape
+  if items < 2 or count < 3:
+    return np.full(items, np.nan)
+  rest = data.sum(axis=1, keepdims=True) - data
+  item_centered = data - data.mean(axis=0)
+  rest_centered = rest - rest.mean(axis=0)
+  numerator = (item_centered * rest_centered).sum(axis=0)
+  denominator = np.sqrt((item_centered ** 2).sum(axis=0) * (rest_centered ** 2).sum(axis=0))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    correlations = numerator / denominator
+  correlations[denominator == 0] = np.nan
+  return correlations
+
+
+def item_difficulty(binary_matrix):
+  """Proportion of participants answering each item correctly."""
+  answered = ~np.isnan(binary_matrix)
+  counts = answered.sum(axis=0)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return np.where(counts > 0, np.nansum(binary_matrix, axis=0) / counts, np.nan)
+
+
+def discrimination_index(binary_matrix, group_fraction=0.27):
+  """Upper-lower group discrimination: difficulty in the top group minus the bottom group."""
+  data = complete_rows(binary_matrix)
+  count, items = data.shape
+  group_size = int(round(count * group_fraction))
+  if group_size < 1 or count < 2 * group_size:
+    return np.full(items, np.nan)
+  order = np.argsort(data.sum(axis=1), kind='stable')
+  lower = data[order[:group_size]]
+  upper = data[order[-group_size:]]
+  return upper.mean(axis=0) - lower.mean(axis=0)
+
+
+def analyze_scale(matrix, item_labels, binary=False):
+  matrix = np.asarray(matrix, dtype=float)
+  if matrix.ndim != 2:
+    matrix = matrix.reshape(0, len(item_labels))
+  missing = np.isnan(matrix)
+  complete = complete_rows(matrix)
+  with warnings.catch_warnings():
+    # 某题没有任何作答时 nanmean/nanstd 会发出警告，结果按缺失处理
+    warnings.simplefilter('ignore', RuntimeWarning)
+    means = np.nanmean(matrix, axis=0) if matrix.shape[0] else np.full(len(item_labels), np.nan)
+    deviations = np.nanstd(matrix, axis=0, ddof=1) if matrix.shape[0] > 1 else np.full(len(item_labels), np.nan)
+
+  result = {
+    'items': list(item_labels),
+    'participants': int(matrix.shape[0]),
+    'complete_cases': int(complete.shape[0]),
+    'cronbach_alpha': to_json_value(cronbach_alpha(matrix)),
+    'item_mean': to_json_values(means),
+    'item_sd': to_json_values(deviations),
+    'corrected_item_total_r': to_json_values(corrected_item_total_correlations(matrix)),
+    'alpha_if_item_deleted': to_json_values(alpha_if_item_deleted(matrix)),
+    'missing_rate': to_json_values(missing.mean(axis=0) if matrix.shape[0] else np.full(len(item_labels), np.nan)),
+    'participants_with_missing': int(missing.any(axis=1).sum()),
+  }
+  if binary:
+    result['difficulty'] = to_json_values(item_difficulty(matrix))
+    result['discrimination'] = to_json_values(discrimination_index(matrix))
+  return result
@@ -1,22 +1,55 @@
+import cProfile
+import argparse
 import csv
+import gzip
 import hashlib
+import hmac
+import http.client
+import io
 import json
 import math
+import os
+import pstats
 import random
 import re
+import shutil
+import signal
+import socket
 import string
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+from collections import Counter, deque
+from collections.abc import Mapping
 from datetime import datetime, timezone
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from urllib.parse import parse_qs, urlparse
 import logging
 
+try:
+  import fcntl
+except ImportError:  # Windows 本地开发时没有 fcntl，只做进程内加锁
+  fcntl = None
+
+try:
+  import item_analysis
+except ImportError:  # numpy 未安装时 /item-analysis 不可用，其余功能不受影响
+  item_analysis = None
+
 HOST = '0.0.0.0'
 PORT = 8765
 BASE_DIR = Path(__file__).resolve().parent
 DATA_DIR = BASE_DIR / 'data'
-USER_RECORD_PATH = DATA_DIR / 'user_record.tsv'
-GROUP_SEQUENCE_PATH = DATA_DIR / 'group_sequence.json'
+CONTENT_DIR = BASE_DIR.parent / 'src' / 'assets'  # 课程脚本和问卷，部署时与前端共用同一份
+CONTENT_RELOAD_CHECK_SECONDS = 2.0
+
+# 以下是默认设置，可在 config.json 中覆盖，发送 SIGHUP 重新加载
+CONFIG_PATH = Path(os.environ.get('PSYCHAT_CONFIG', BASE_DIR / 'config.json'))
+# 多个实验共用一个后端时在 studies.json 中列出，每个实验有自己的 URL 前缀、数据目录和配置
+STUDIES_PATH = Path(os.environ.get('PSYCHAT_STUDIES', BASE_DIR / 'studies.json'))
 
 RETURN_INCOMPLETE_SWITCH_GROUP = True  # 是否允许相同用户尝试另一个group的题目
 
@@ -35,7 +68,17 @@ REQUIRED_FORM_FILES = [
 
 GROUP_KEYS = ('group1', 'group2', 'group3', 'group4')
 
-DATA_DIR.mkdir(exist_ok=True)
+# 定期把已完成/已放弃的被试打包归档，归档后仍可导出
+RETENTION_SWEEP_ENABLED = True
+RETENTION_SWEEP_INTERVAL_SECONDS = 60 * 60
+RETENTION_COMPLETE_GRACE_SECONDS = 24 * 60 * 60  # 完成后多久没有新写入才归档
+RETENTION_ABANDONED_TTL_SECONDS = 7 * 24 * 60 * 60  # 未完成且超过该时长没有写入视为放弃
+
+DRAIN_TIMEOUT_SECONDS = 30  # 收到 SIGTERM 后等待进行中请求完成的最长时间
+PID_PATH = BASE_DIR / 'server.pid'
+
+PROGRESS_HISTORY_SIZE = 512  # /progress 断线重连时可补发的事件数
+PROGRESS_KEEPALIVE_SECONDS = 15
 
 USER_RECORD_BASE_COLUMNS = [
   'userid',
@@ -115,6 +158,17 @@ console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(mess
 logger.addHandler(file_handler)
 logger.addHandler(console_handler)
 
+# 请求采样分析：PSYCHAT_PROFILE_RATE 为采样比例，PSYCHAT_PROFILE_SECONDS 为持续时间（0 表示不限）
+PROFILE_DIR = LOG_DIR / 'profile'
+PROFILE_SUMMARY_TOP = 40
+PROFILE_FLAME_MAX_DEPTH = 40
+PROFILE_MAX_DUMPS = 200  # 最多保留的 .pstats 文件数，超出时删除最早的
+# 管理接口（/admin/profile）只在设置了 PSYCHAT_ADMIN_TOKEN 时开放
+ADMIN_TOKEN = os.environ.get('PSYCHAT_ADMIN_TOKEN', '')
+
+# 设置 PSYCHAT_CAPTURE_PATH 后把每个 API 请求追加记录到该文件，供 replay 命令回放
+CAPTURE_PATH = os.environ.get('PSYCHAT_CAPTURE_PATH', '')
+
 def stringify_value(value):
   if value is None:
     return ''
@@ -162,46 +216,336 @@ def read_json_file(path):
     return None
 
 
+RECORD_SUFFIX = '.rec'
+RECORD_MAGIC = 'psyrec'
+RECORD_VERSION = 1
+# 由作答重新计算、不写入 .rec 的计分字段
+DERIVED_SCORE_FIELDS = {
+  'post2': ('scores',),
+  'post6_1': ('details',),
+}
+
+
+def encode_form_record(form_key, record):
+  # 表单记录的紧凑 .rec 文本，不符合格式时返回 None
+  # 第 1 行是格式版本，之后每行一个 JSON 值：头部（received_at、去掉 answers 的 payload、得分字段名、post6_1 答案）、
+  # 得分、按题号排序的作答、题号（1..n 时为 null）、题目文本
+  payload = record.get('payload')
+  answers = payload.get('answers') if isinstance(payload, dict) else None
+  if not isinstance(answers, list):
+    return None
+  indices = []
+  values = []
+  questions = []
+  for position, entry in enumerate(answers, start=1):
+    if not isinstance(entry, dict) or 'selected_choice' not in entry or set(entry) - {'index', 'question', 'selected_choice'}:
+      return None
+    indices.append(entry.get('index') or position)
+    values.append(entry['selected_choice'])
+    questions.append(entry.get('question'))
+  if not all(isinstance(index, int) for index in indices) or len(set(indices)) != len(indices):
+    return None
+  if any('question' in entry for entry in answers) and not all('question' in entry for entry in answers):
+    return None
+  order = sorted(range(len(indices)), key=indices.__getitem__)
+  indices = [indices[position] for position in order]
+  values = [values[position] for position in order]
+  questions = [questions[position] for position in order]
+
+  score = record.get('score')
+  score_fields = None
+  score_values = None
+  if score is not None:
+    if not isinstance(score, dict):
+      return None
+    derived = DERIVED_SCORE_FIELDS.get(form_key, ())
+    score_fields = [key for key in score if key not in derived]
+    score_values = [score[key] for key in score_fields]
+    if not all(value is None or isinstance(value, (bool, int, float, str)) for value in score_values):
+      return None
+
+  header = {
+    'received_at': record.get('received_at'),
+    'payload': {key: value for key, value in payload.items() if key != 'answers'},
+    'score_fields': score_fields,
+  }
+  details = score.get('details') if isinstance(score, dict) else None
+  if form_key == 'post6_1' and isinstance(details, list):
+    # 保存提交时使用的答案，之后重新计算 details 时与 total_score 一致（配置中的答案可能已修改）
+    try:
+      header['answer_key'] = {str(item['index']): ''.join(item['expected']) for item in details}
+    except (KeyError, TypeError):
+      return None
+  sections = [
+    header,
+    score_values,
+    values,
+    None if indices == list(range(1, len(indices) + 1)) else indices,
+    questions if answers and 'question' in answers[0] else None,
+  ]
+  lines = [f'{RECORD_MAGIC} {RECORD_VERSION}']
+  lines.extend(json.dumps(section, ensure_ascii=False, separators=(',', ':')) for section in sections)
+  return '\n'.join(lines) + '\n'
+
+
+class CompactRecord(Mapping):
+  # 从 .rec 文件读出的表单记录，各部分在第一次访问时才解析
+  def __init__(self, form_key, text):
+    lines = text.split('\n')
+    if len(lines) < 6 or lines[0] != f'{RECORD_MAGIC} {RECORD_VERSION}':
+      raise ValueError(f'unsupported record format: {lines[0][:40]!r}')
+    self.form_key = form_key
+    self.header = json.loads(lines[1])
+    if not isinstance(self.header, dict):
+      raise ValueError('record header must be an object')
+    self.sections = lines[2:6]
+    self.decoded = {}
+
+  def section(self, position):
+    if position not in self.decoded:
+      try:
+        self.decoded[position] = json.loads(self.sections[position])
+      except json.JSONDecodeError:
+        self.decoded[position] = None
+    return self.decoded[position]
+
+  def answer_map(self):
+    values = self.section(1) or []
+    indices = self.section(2) or range(1, len(values) + 1)
+    return dict(zip(indices, values))
+
+  def answers(self):
+    values = self.section(1) or []
+    indices = self.section(2) or range(1, len(values) + 1)
+    questions = self.section(3)
+    answers = []
+    for position, (index, value) in enumerate(zip(indices, values)):
+      entry = {'index': index}
+      if questions is not None:
+        entry['question'] = questions[position]
+      entry['selected_choice'] = value
+      answers.append(entry)
+    return answers
+
+  def score(self, with_details=False):
+    # 读取保存的得分；post6_1 的逐题结果只在需要时按记录中的答案重新计算
+    fields = self.header.get('score_fields')
+    if fields is None:
+      return None
+    score = dict(zip(fields, self.section(0) or ()))
+    if self.form_key == 'post2':
+      score.update(score_post2(self.answers()))
+    elif self.form_key == 'post6_1' and with_details and isinstance(self.header.get('answer_key'), dict):
+      correct = {int(index): set(letters) for index, letters in self.header['answer_key'].items()}
+      score['details'] = grade_post61(self.answers(), correct)['details']
+    return score
+
+  def to_dict(self):
+    record = {'received_at': self.header.get('received_at'), 'payload': self['payload']}
+    score = self.score(with_details=True)
+    if score is not None:
+      record['score'] = score
+    return record
+
+  def __getitem__(self, key):
+    if key == 'received_at':
+      return self.header.get('received_at')
+    if key == 'payload':
+      payload = dict(self.header.get('payload') or {})
+      payload['answers'] = self.answers()
+      return payload
+    if key == 'score' and self.header.get('score_fields') is not None:
+      return self.score()
+    raise KeyError(key)
+
+  def __iter__(self):
+    yield 'received_at'
+    yield 'payload'
+    if self.header.get('score_fields') is not None:
+      yield 'score'
+
+  def __len__(self):
+    return 3 if self.header.get('score_fields') is not None else 2
+
+
+def decode_form_record(form_key, text):
+  try:
+    return CompactRecord(form_key, text)
+  except (ValueError, IndexError) as error:
+    logger.error(f'Unreadable {form_key}{RECORD_SUFFIX}: {error}')
+    return None
+
+
+def read_form_record(forms_dir, filename):
+  # 读取 forms/<key>.rec，没有时读旧格式 forms/<key>.json
+  form_key = filename[:-len('.json')]
+  compact_path = forms_dir / f'{form_key}{RECORD_SUFFIX}'
+  if compact_path.exists():
+    try:
+      return decode_form_record(form_key, compact_path.read_text(encoding='utf-8'))
+    except OSError:
+      return None
+  return read_json_file(forms_dir / filename)
+
+
+def form_record_exists(forms_dir, filename):
+  form_key = filename[:-len('.json')]
+  return (forms_dir / f'{form_key}{RECORD_SUFFIX}').exists() or (forms_dir / filename).exists()
+
+
+def write_form_record(forms_dir, form_key, record):
+  text = encode_form_record(form_key, record)
+  compact_path = forms_dir / f'{form_key}{RECORD_SUFFIX}'
+  legacy_path = forms_dir / f'{form_key}.json'
+  if text is None:
+    legacy_path.write_text(json.dumps(record, ensure_ascii=False, indent=2), encoding='utf-8')
+    compact_path.unlink(missing_ok=True)
+  else:
+    compact_path.write_text(text, encoding='utf-8')
+    legacy_path.unlink(missing_ok=True)
+
+
+def form_answer_map(form_record):
+  if isinstance(form_record, CompactRecord):
+    return form_record.answer_map()
+  if not isinstance(form_record, dict):
+    return {}
+  payload = form_record.get('payload')
+  return answers_to_map(payload.get('answers') if isinstance(payload, dict) else None)
+
+
 def extract_answer(form_record, target_index):
-  answers = form_record.get('payload', {}).get('answers', []) if isinstance(form_record, dict) else []
-  for fallback_index, entry in enumerate(answers, start=1):
-    if not isinstance(entry, dict):
-      continue
-    index = entry.get('index') or fallback_index
-    if index == target_index:
-      return entry.get('selected_choice')
-  return None
+  return form_answer_map(form_record).get(target_index)
 
 
 def record_form_answers(row, form_key, form_record):
-  if not isinstance(row, dict) or not form_key or not isinstance(form_record, dict):
-    return
-  answers = form_record.get('payload', {}).get('answers', [])
-  if not isinstance(answers, list):
+  if not isinstance(row, dict) or not form_key:
     return
-  for fallback_index, entry in enumerate(answers, start=1):
-    if not isinstance(entry, dict):
-      continue
-    index = entry.get('index') or fallback_index
+  for index, value in form_answer_map(form_record).items():
     column = f'{form_key}-q{index}-answer'
     if column in row:
-      row[column] = sanitize_tsv_value(entry.get('selected_choice'))
+      row[column] = sanitize_tsv_value(value)
 
 
-def build_user_record_row(user_id):
-  user_dir = DATA_DIR / user_id
-  if not user_dir.exists():
-    return None
+def shard_parts(user_id):
+  digest = hashlib.sha1(user_id.encode('utf-8')).hexdigest()
+  return digest[:2], digest[2:4]
+
+
+def user_dir_path(study, user_id):
+  # 被试目录按 userid 哈希分两级存放：data/ab/cd/<userid>；迁移前的平铺目录仍可读写
+  first, second = shard_parts(user_id)
+  sharded = study.data_dir / first / second / user_id
+  if not sharded.exists() and not user_id.startswith('_') and not is_shard_name(user_id):
+    legacy = study.data_dir / user_id
+    if legacy.is_dir():
+      return legacy
+  return sharded
+
+
+def is_shard_name(name):
+  return len(name) == 2 and all(char in '0123456789abcdef' for char in name)
+
+
+def sorted_entries(path):
+  with os.scandir(path) as entries:
+    return sorted(entries, key=lambda entry: entry.name)
+
 
+def iter_user_dirs(study):
+  # 逐个分片目录列出在线被试，不一次性列出整个目录树
+  # 每一级分别排序（每级最多 256 项），遍历顺序不依赖文件系统，导出的行顺序可复现
+  for top in sorted_entries(study.data_dir):
+    if not top.is_dir() or top.name.startswith('_'):
+      continue
+    if not is_shard_name(top.name):
+      yield top.name, Path(top.path)
+      continue
+    for second in sorted_entries(top.path):
+      if not second.is_dir():
+        continue
+      for entry in sorted_entries(second.path):
+        if entry.is_dir():
+          yield entry.name, Path(entry.path)
+
+
+def migrate_to_shards(study):
+  moved = 0
+  with study.storage_lock:
+    legacy_dirs = [
+      entry for entry in study.data_dir.iterdir()
+      if entry.is_dir() and not entry.name.startswith('_') and not is_shard_name(entry.name)
+    ]
+    for legacy in legacy_dirs:
+      first, second = shard_parts(legacy.name)
+      target = study.data_dir / first / second / legacy.name
+      if target.exists():
+        logger.warning(f'Skipping {legacy.name}: {target} already exists')
+        continue
+      target.parent.mkdir(parents=True, exist_ok=True)
+      legacy.rename(target)
+      moved += 1
+  return moved
+
+
+def convert_user_records(study, target='compact'):
+  # 把在线被试的表单记录转换为 .rec（target='compact'）或转回 .json；归档不处理
+  summary = {'converted': 0, 'kept': 0, 'failed': 0}
+  source_suffix = '.json' if target == 'compact' else RECORD_SUFFIX
+  with study.storage_lock:
+    for user_id, user_dir in iter_user_dirs(study):
+      forms_dir = user_dir / 'forms'
+      if not forms_dir.is_dir():
+        continue
+      for path in sorted(forms_dir.glob(f'*{source_suffix}')):
+        form_key = path.name[:-len(source_suffix)]
+        record = read_form_record(forms_dir, f'{form_key}.json')
+        if record is None:
+          logger.warning(f'Skipping unreadable {user_id}/forms/{path.name}')
+          summary['failed'] += 1
+          continue
+        if target == 'compact':
+          text = encode_form_record(form_key, record)
+          if text is None:
+            summary['kept'] += 1
+            continue
+          (forms_dir / f'{form_key}{RECORD_SUFFIX}').write_text(text, encoding='utf-8')
+        else:
+          legacy = record.to_dict() if isinstance(record, CompactRecord) else record
+          (forms_dir / f'{form_key}.json').write_text(json.dumps(legacy, ensure_ascii=False, indent=2), encoding='utf-8')
+        path.unlink()
+        summary['converted'] += 1
+  return summary
+
+
+def live_user_reader(user_dir):
   forms_dir = user_dir / 'forms'
   forms_dir_exists = forms_dir.exists()
+
+  def read_json(name):
+    if name.startswith('forms/'):
+      if not forms_dir_exists:
+        return None
+      return read_form_record(forms_dir, name[len('forms/'):])
+    return read_json_file(user_dir / name)
+
+  return read_json
+
+
+def build_user_record_row(study, user_id, read_json=None):
+  if read_json is None:
+    user_dir = user_dir_path(study, user_id)
+    if not user_dir.exists():
+      return None
+    read_json = live_user_reader(user_dir)
+
   row = {column: '' for column in USER_RECORD_COLUMNS}
   row['userid'] = sanitize_tsv_value(user_id)
 
-  group_data = read_json_file(user_dir / 'group.json') or {}
+  group_data = read_json('group.json') or {}
   row['group'] = sanitize_tsv_value(group_data.get('group'))
 
-  lesson_record = read_json_file(user_dir / 'lesson.json')
+  lesson_record = read_json('lesson.json')
   if lesson_record:
     duration_ms = lesson_record.get('payload', {}).get('duration_ms') if isinstance(lesson_record, dict) else None
     if isinstance(duration_ms, (int, float)):
@@ -209,7 +553,7 @@ def build_user_record_row(user_id):
     elif duration_ms is not None:
       row['lesson-duration_seconds'] = sanitize_tsv_value(duration_ms)
 
-  pre1 = read_json_file(forms_dir / 'pre1-info.json') if forms_dir_exists else None
+  pre1 = read_json('forms/pre1-info.json')
   if pre1:
     record_form_answers(row, 'pre1-info', pre1)
     row['pre1-age'] = sanitize_tsv_value(extract_answer(pre1, 1))
@@ -218,26 +562,26 @@ def build_user_record_row(user_id):
     row['pre1-grade'] = sanitize_tsv_value(extract_answer(pre1, 4))
     row['pre1-ai_attitude'] = sanitize_tsv_value(extract_answer(pre1, 5))
 
-  pre2 = read_json_file(forms_dir / 'pre2.json') if forms_dir_exists else None
+  pre2 = read_json('forms/pre2.json')
   if pre2:
     record_form_answers(row, 'pre2', pre2)
   if pre2 and isinstance(pre2.get('score'), dict):
     row['pre2-positive_affect'] = sanitize_tsv_value(pre2['score'].get('positive_affect'))
     row['pre2-negative_affect'] = sanitize_tsv_value(pre2['score'].get('negative_affect'))
 
-  pre3 = read_json_file(forms_dir / 'pre3.json') if forms_dir_exists else None
+  pre3 = read_json('forms/pre3.json')
   if pre3:
     record_form_answers(row, 'pre3', pre3)
   if pre3 and isinstance(pre3.get('score'), dict):
     row['pre3-average_score'] = sanitize_tsv_value(pre3['score'].get('average_score'))
 
-  pre4 = read_json_file(forms_dir / 'pre4.json') if forms_dir_exists else None
+  pre4 = read_json('forms/pre4.json')
   if pre4:
     record_form_answers(row, 'pre4', pre4)
   if pre4 and isinstance(pre4.get('score'), dict):
     row['pre4-total_score'] = sanitize_tsv_value(pre4['score'].get('total_score'))
 
-  post1 = read_json_file(forms_dir / 'post1.json') if forms_dir_exists else None
+  post1 = read_json('forms/post1.json')
   if post1:
     record_form_answers(row, 'post1', post1)
   if post1 and isinstance(post1.get('score'), dict):
@@ -246,7 +590,7 @@ def build_user_record_row(user_id):
       if column in row:
         row[column] = sanitize_tsv_value(post1['score'].get(key))
 
-  post2 = read_json_file(forms_dir / 'post2.json') if forms_dir_exists else None
+  post2 = read_json('forms/post2.json')
   if post2:
     record_form_answers(row, 'post2', post2)
     scores = post2.get('score', {}).get('scores', {}) if isinstance(post2.get('score'), dict) else {}
@@ -255,14 +599,14 @@ def build_user_record_row(user_id):
       if column in row:
         row[column] = sanitize_tsv_value(scores.get(key))
 
-  post3 = read_json_file(forms_dir / 'post3.json') if forms_dir_exists else None
+  post3 = read_json('forms/post3.json')
   if post3:
     record_form_answers(row, 'post3', post3)
   if post3 and isinstance(post3.get('score'), dict):
     row['post3-positive_affect'] = sanitize_tsv_value(post3['score'].get('positive_affect'))
     row['post3-negative_affect'] = sanitize_tsv_value(post3['score'].get('negative_affect'))
 
-  post4 = read_json_file(forms_dir / 'post4.json') if forms_dir_exists else None
+  post4 = read_json('forms/post4.json')
   if post4:
     record_form_answers(row, 'post4', post4)
   if post4 and isinstance(post4.get('score'), dict):
@@ -271,34 +615,34 @@ def build_user_record_row(user_id):
       if column in row:
         row[column] = sanitize_tsv_value(post4['score'].get(key))
 
-  post5 = read_json_file(forms_dir / 'post5.json') if forms_dir_exists else None
+  post5 = read_json('forms/post5.json')
   if post5:
     record_form_answers(row, 'post5', post5)
   if post5 and isinstance(post5.get('score'), dict):
     row['post5-average_score'] = sanitize_tsv_value(post5['score'].get('average_score'))
 
-  post6_1 = read_json_file(forms_dir / 'post6_1.json') if forms_dir_exists else None
+  post6_1 = read_json('forms/post6_1.json')
   if post6_1:
     record_form_answers(row, 'post6_1', post6_1)
   if post6_1 and isinstance(post6_1.get('score'), dict):
     row['post6_1-total_score'] = sanitize_tsv_value(post6_1['score'].get('total_score'))
 
-  post6_2 = read_json_file(forms_dir / 'post6_2.json') if forms_dir_exists else None
+  post6_2 = read_json('forms/post6_2.json')
   if post6_2:
     record_form_answers(row, 'post6_2', post6_2)
 
   return row
 
 
-def upsert_user_record(row):
+def upsert_user_record(study, row):
   if not row or 'userid' not in row or not row['userid']:
     return
 
   existing_rows = []
   header_matches = False
-  if USER_RECORD_PATH.exists():
+  if study.user_record_path.exists():
     try:
-      with USER_RECORD_PATH.open('r', encoding='utf-8', newline='') as handle:
+      with study.user_record_path.open('r', encoding='utf-8', newline='') as handle:
         reader = csv.reader(handle, delimiter='\t')
         header = next(reader, None)
         header_matches = header == USER_RECORD_COLUMNS
@@ -325,18 +669,18 @@ def upsert_user_record(row):
   if not updated:
     existing_rows.append((row['userid'], row_values))
 
-  with USER_RECORD_PATH.open('w', encoding='utf-8', newline='') as handle:
+  with study.user_record_path.open('w', encoding='utf-8', newline='') as handle:
     writer = csv.writer(handle, delimiter='\t', lineterminator='\n')
     writer.writerow(USER_RECORD_COLUMNS)
     for _, values in existing_rows:
       writer.writerow(values)
 
 
-def read_existing_user_record_userids():
-  if not USER_RECORD_PATH.exists():
+def read_existing_user_record_userids(study):
+  if not study.user_record_path.exists():
     return set()
   try:
-    with USER_RECORD_PATH.open('r', encoding='utf-8', newline='') as handle:
+    with study.user_record_path.open('r', encoding='utf-8', newline='') as handle:
       reader = csv.reader(handle, delimiter='\t')
       header = next(reader, None)
       if header != USER_RECORD_COLUMNS:
@@ -353,8 +697,8 @@ def read_existing_user_record_userids():
     return set()
 
 
-def has_complete_user_data(user_id):
-  user_dir = DATA_DIR / user_id
+def has_complete_user_data(study, user_id, user_dir=None):
+  user_dir = user_dir or user_dir_path(study, user_id)
   if not user_dir.exists():
     return False
   if not (user_dir / 'group.json').exists():
@@ -362,33 +706,385 @@ def has_complete_user_data(user_id):
   forms_dir = user_dir / 'forms'
   if not forms_dir.exists():
     return False
-  for filename in REQUIRED_FORM_FILES:
-    if not (forms_dir / filename).exists():
+  for filename in study.settings.required_form_files:
+    if not form_record_exists(forms_dir, filename):
       return False
   return True
 
 
-def bootstrap_user_records():
-  rows = []
-  for entry in sorted(DATA_DIR.iterdir(), key=lambda path: path.name):
-    if not entry.is_dir():
-      continue
-    user_id = entry.name
-    row = build_user_record_row(user_id)
-    if row:
-      rows.append(row)
+def user_last_activity(user_dir):
+  latest = 0.0
+  for root, _, files in os.walk(user_dir):
+    for name in files:
+      try:
+        latest = max(latest, os.stat(os.path.join(root, name)).st_mtime)
+      except OSError:
+        continue
+  if not latest:
+    try:
+      latest = user_dir.stat().st_mtime
+    except OSError:
+      pass
+  return latest
+
+
+def classify_user(study, user_id, now=None, user_dir=None):
+  user_dir = user_dir or user_dir_path(study, user_id)
+  now = time.time() if now is None else now
+  idle_seconds = now - user_last_activity(user_dir)
+  if has_complete_user_data(study, user_id, user_dir):
+    return 'complete', idle_seconds
+  if idle_seconds >= RETENTION_ABANDONED_TTL_SECONDS:
+    return 'abandoned', idle_seconds
+  return 'in_progress', idle_seconds
+
+
+ARCHIVE_SUMMARY_VERSION = 2
+
+
+def archive_summary_path(archive_path):
+  return archive_path.with_name(archive_path.name[:-len('.tar.gz')] + '.summary.jsonl')
+
+
+def archive_index_path(study):
+  return study.archive_dir / 'index.tsv'
+
+
+def user_progress_entry(read_json, form_files):
+  # 只有 /register 写入 registered_at；GET /completion 等接口为未知 userid 建的目录不算注册
+  form_keys = sorted({name.rsplit('.', 1)[0] for name in form_files if name.endswith(('.json', RECORD_SUFFIX))})
+  meta = read_json('meta.json') or {}
+  return {
+    'registered': bool(meta.get('registered_at')),
+    'group': (read_json('group.json') or {}).get('group'),
+    'forms': form_keys,
+    'lesson': read_json('lesson.json') is not None,
+    'completed': bool(meta.get('completed')),
+  }
 
+
+def summarize_user(study, user_id, read_json, form_files):
+  # 归档摘要中每个被试一行：导出行（只存非空单元格）、题目分析用的作答、进度计数用的状态
+  row = build_user_record_row(study, user_id, read_json) or {}
+  return {
+    'userid': user_id,
+    'row': {column: value for column, value in row.items() if value != ''},
+    'answers': collect_item_answers(read_json),
+    'progress': user_progress_entry(read_json, form_files),
+  }
+
+
+def archive_member_reader(members):
+  parsed = {}
+
+  def read_json(name):
+    if name not in parsed:
+      form_key = name[len('forms/'):-len('.json')] if name.startswith('forms/') else None
+      compact = members.get(f'forms/{form_key}{RECORD_SUFFIX}') if form_key else None
+      content = members.get(name)
+      try:
+        if compact is not None:
+          parsed[name] = decode_form_record(form_key, compact.decode('utf-8'))
+        else:
+          parsed[name] = json.loads(content.decode('utf-8')) if content is not None else None
+      except (json.JSONDecodeError, UnicodeDecodeError):
+        parsed[name] = None
+    return parsed[name]
+
+  return read_json
+
+
+def write_archive_summary(summary_path, entries):
+  # 导出和题目分析可能同时为旧归档生成摘要，临时文件名按线程区分
+  tmp_path = summary_path.with_name(f'{summary_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+  with tmp_path.open('w', encoding='utf-8') as handle:
+    handle.write(json.dumps({'version': ARCHIVE_SUMMARY_VERSION}) + '\n')
+    for entry in entries:
+      handle.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+  tmp_path.replace(summary_path)
+
+
+def summarize_archive(study, archive_path):
+  # 没有摘要（旧版本生成）或摘要版本过期的归档，解压一次生成摘要；一次只处理一个被试
+  summary_path = archive_summary_path(archive_path)
+  current_user = None
+  members = {}
+  entries = []
+
+  def flush():
+    if current_user is not None:
+      form_files = [name[len('forms/'):] for name in members if name.startswith('forms/')]
+      entries.append(summarize_user(study, current_user, archive_member_reader(members), form_files))
+
+  with tarfile.open(archive_path, 'r:gz') as archive:
+    for member in archive:
+      if not member.isfile():
+        continue
+      user_id, _, name = member.name.partition('/')
+      if user_id != current_user:
+        flush()
+        current_user, members = user_id, {}
+      handle = archive.extractfile(member)
+      if handle is not None:
+        members[name] = handle.read()
+  flush()
+  write_archive_summary(summary_path, entries)
+  return summary_path
+
+
+def iter_archive_summary(study, archive_path):
+  summary_path = archive_summary_path(archive_path)
   try:
-    with USER_RECORD_PATH.open('w', encoding='utf-8', newline='') as handle:
+    with summary_path.open('r', encoding='utf-8') as handle:
+      header = json.loads(handle.readline() or '{}')
+  except (OSError, json.JSONDecodeError):
+    header = {}
+  if header.get('version') != ARCHIVE_SUMMARY_VERSION:
+    summarize_archive(study, archive_path)
+  with summary_path.open('r', encoding='utf-8') as handle:
+    handle.readline()
+    for line in handle:
+      entry = json.loads(line)
+      entry['answers'] = {
+        form_key: {int(index): value for index, value in answers.items()}
+        for form_key, answers in entry['answers'].items()
+      }
+      yield entry
+
+
+def iter_archived_entries(study, skip_user_ids=()):
+  # 同一被试可能在恢复后再次归档，以最新的归档为准
+  seen = set(skip_user_ids)
+  for archive_path in sorted(study.archive_dir.glob('*.tar.gz'), reverse=True):
+    try:
+      for entry in iter_archive_summary(study, archive_path):
+        if entry['userid'] not in seen:
+          seen.add(entry['userid'])
+          yield entry
+    except (OSError, tarfile.TarError, json.JSONDecodeError, KeyError) as error:
+      logger.error(f'Reading archive {archive_path.name} failed: {error}')
+
+
+def iter_archived_rows(study, skip_user_ids=()):
+  for entry in iter_archived_entries(study, skip_user_ids):
+    yield dict(entry['row'], userid=entry['userid'])
+
+
+def rebuild_archive_index(study):
+  index_path = archive_index_path(study)
+  tmp_path = index_path.with_name(f'{index_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+  with tmp_path.open('w', encoding='utf-8') as handle:
+    for archive_path in sorted(study.archive_dir.glob('*.tar.gz')):
+      try:
+        for entry in iter_archive_summary(study, archive_path):
+          handle.write(f'{entry["userid"]}\t{archive_path.name}\n')
+      except (OSError, tarfile.TarError, json.JSONDecodeError, KeyError) as error:
+        logger.error(f'Indexing archive {archive_path.name} failed: {error}')
+  tmp_path.replace(index_path)
+
+
+def archived_user_index(study):
+  # userid -> 所在的最新归档；只保存在 _archive/index.tsv，内存中按文件修改时间缓存这张小表
+  index_path = archive_index_path(study)
+  if not index_path.exists():
+    if not any(study.archive_dir.glob('*.tar.gz')):
+      return {}
+    rebuild_archive_index(study)
+  stat = index_path.stat()
+  cache_key = (stat.st_mtime_ns, stat.st_size)
+  if study.archive_index_cache and study.archive_index_cache[0] == cache_key:
+    return study.archive_index_cache[1]
+  index = {}
+  with index_path.open('r', encoding='utf-8') as handle:
+    for line in handle:
+      user_id, _, archive_name = line.rstrip('\n').partition('\t')
+      if archive_name:
+        index[user_id] = study.archive_dir / archive_name
+  study.archive_index_cache = (cache_key, index)
+  return index
+
+
+def archive_users(study, user_dirs, cohort_name):
+  # 打包和生成摘要不持有锁；删除目录前逐个持锁检查，打包期间有新写入的被试保留在数据目录中
+  archive_path = study.archive_dir / f'{cohort_name}.tar.gz'
+  tmp_path = archive_path.with_name(archive_path.name + '.tmp')
+  snapshot = []
+  entries = []
+  with tarfile.open(tmp_path, 'w:gz') as archive:
+    for user_id, user_dir in user_dirs:
+      last_activity = user_last_activity(user_dir)
+      archive.add(user_dir, arcname=user_id)
+      forms_dir = user_dir / 'forms'
+      form_files = os.listdir(forms_dir) if forms_dir.is_dir() else []
+      entries.append(summarize_user(study, user_id, live_user_reader(user_dir), form_files))
+      snapshot.append((user_id, user_dir, last_activity))
+  write_archive_summary(archive_summary_path(archive_path), entries)
+  with study.storage_lock:
+    tmp_path.replace(archive_path)
+    if archive_index_path(study).exists():
+      with archive_index_path(study).open('a', encoding='utf-8') as handle:
+        handle.writelines(f'{user_id}\t{archive_path.name}\n' for user_id, _, _ in snapshot)
+    else:
+      rebuild_archive_index(study)
+
+  removed = 0
+  for user_id, user_dir, last_activity in snapshot:
+    with study.storage_lock:
+      if user_last_activity(user_dir) != last_activity:
+        continue
+      shutil.rmtree(user_dir, ignore_errors=True)
+      for shard_dir in (user_dir.parent, user_dir.parent.parent):
+        if shard_dir == study.data_dir:
+          break
+        try:
+          shard_dir.rmdir()
+        except OSError:
+          break
+      removed += 1
+  return archive_path, removed
+
+
+def sweep_user_data(study, now=None):
+  # 分类和打包都在锁外进行，只有恢复、删除单个被试目录时短暂持锁，不阻塞请求
+  now = time.time() if now is None else now
+  summary = {'complete': 0, 'in_progress': 0, 'abandoned': 0, 'archived': 0}
+  to_archive = []
+  archive_index = archived_user_index(study)
+  for user_id, user_dir in iter_user_dirs(study):
+    if user_id in archive_index and not holds_live_data(user_dir):
+      # 再次归档前补全，避免新的归档只含部分数据却被当作最新
+      with study.storage_lock:
+        if not holds_live_data(user_dir):
+          restore_archived_user(study, user_id, user_dir, archive_index)
+    status, idle_seconds = classify_user(study, user_id, now, user_dir)
+    summary[status] += 1
+    if status == 'abandoned':
+      to_archive.append((user_id, user_dir))
+    elif status == 'complete' and idle_seconds >= RETENTION_COMPLETE_GRACE_SECONDS:
+      to_archive.append((user_id, user_dir))
+  if to_archive:
+    cohort_name = datetime.fromtimestamp(now, timezone.utc).strftime('cohort_%Y%m%d_%H%M%S')
+    try:
+      archive_path, removed = archive_users(study, sorted(to_archive), cohort_name)
+    except OSError as error:
+      logger.error(f'[{study.name}] Archiving {len(to_archive)} users failed: {error}')
+    else:
+      summary['archived'] = removed
+      logger.info(f'[{study.name}] Archived {removed} users into {archive_path.name}')
+  return summary
+
+
+def holds_live_data(user_dir):
+  # 只有注册或从归档恢复过的目录才有 meta.json；仅被查询创建的空目录不能覆盖归档中的数据
+  return (user_dir / 'meta.json').exists()
+
+
+def restore_archived_user(study, user_id, user_dir, archive_index=None):
+  # 把归档中该被试的文件放回 user_dir，已有的文件保持不变
+  archive_index = archived_user_index(study) if archive_index is None else archive_index
+  archive_path = archive_index.get(user_id)
+  if archive_path is None:
+    return False
+  restored = 0
+  with tarfile.open(archive_path, 'r:gz') as archive:
+    for member in archive:
+      member_user, _, name = member.name.partition('/')
+      if member_user != user_id or not member.isfile():
+        continue
+      parts = Path(name).parts
+      if not parts or '..' in parts or Path(name).is_absolute():
+        continue
+      target = user_dir.joinpath(*parts)
+      if target.exists():
+        continue
+      handle = archive.extractfile(member)
+      if handle is None:
+        continue
+      target.parent.mkdir(parents=True, exist_ok=True)
+      target.write_bytes(handle.read())
+      # 保留原修改时间，恢复本身不算作新的活动
+      os.utime(target, (member.mtime, member.mtime))
+      restored += 1
+  if restored:
+    logger.info(f'[{study.name}] Restored {restored} files of {user_id} from {archive_path.name}')
+  return True
+
+
+def bootstrap_user_records(study):
+  # 逐个目录生成并写出，不在内存中收集和排序全部被试；行顺序即目录遍历顺序
+  # 先写临时文件，只在替换时持锁，重建期间其他请求（包括交接中的另一个进程）不必等待
+  archive_index = archived_user_index(study)
+  live_user_ids = set()
+  tmp_path = study.user_record_path.with_name(f'{study.user_record_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+  try:
+    with tmp_path.open('w', encoding='utf-8', newline='') as handle:
       writer = csv.writer(handle, delimiter='\t', lineterminator='\n')
       writer.writerow(USER_RECORD_COLUMNS)
-      for row in rows:
+      for user_id, user_dir in iter_user_dirs(study):
+        if user_id in archive_index and not holds_live_data(user_dir):
+          continue
+        row = build_user_record_row(study, user_id, live_user_reader(user_dir))
+        if row:
+          live_user_ids.add(row['userid'])
+          writer.writerow([row.get(column, '') for column in USER_RECORD_COLUMNS])
+      for row in iter_archived_rows(study, live_user_ids):
         writer.writerow([row.get(column, '') for column in USER_RECORD_COLUMNS])
+    with study.storage_lock:
+      tmp_path.replace(study.user_record_path)
   except OSError:
+    tmp_path.unlink(missing_ok=True)
     return
 
 
-bootstrap_user_records()
+def seed_progress(study):
+  # 启动时按已保存的数据设置 /progress 的初始值，重启或交接后计数不会清零
+  archive_index = archived_user_index(study)
+  entries = {}
+  for user_id, user_dir in iter_user_dirs(study):
+    if user_id in archive_index and not holds_live_data(user_dir):
+      continue
+    # 不持锁读取：交接时旧进程可能正好把这个目录归档删除，读不到就跳过，稍后从归档摘要中计入
+    try:
+      form_files = os.listdir(user_dir / 'forms')
+    except FileNotFoundError:
+      form_files = []
+    try:
+      entry = user_progress_entry(live_user_reader(user_dir), form_files)
+    except OSError:
+      continue
+    if user_dir.is_dir():
+      entries[user_id] = entry
+  for entry in iter_archived_entries(study, entries):
+    entries[entry['userid']] = entry['progress']
+
+  groups = {}
+  forms = {}
+  for entry in entries.values():
+    if entry['group']:
+      groups[entry['group']] = groups.get(entry['group'], 0) + 1
+    for form_key in entry['forms']:
+      forms[form_key] = forms.get(form_key, 0) + 1
+  study.progress.seed(
+    registrations=sum(1 for entry in entries.values() if entry['registered']),
+    groups=groups,
+    forms=forms,
+    lessons_completed=sum(1 for entry in entries.values() if entry['lesson']),
+    completions=sum(1 for entry in entries.values() if entry['completed']),
+  )
+
+
+def run_retention_sweeper(studies, stop_event):
+  while not stop_event.wait(RETENTION_SWEEP_INTERVAL_SECONDS):
+    for study in studies:
+      try:
+        summary = sweep_user_data(study)
+      except Exception:  # noqa: BLE001 - keep the sweeper thread alive
+        logger.exception(f'[{study.name}] Retention sweep failed')
+        continue
+      logger.info(f'[{study.name}] Retention sweep finished: {summary}')
+
+
+USER_ID_PATTERN = re.compile(r'[a-z0-9]{16}')
 
 
 def generate_user_id(length=16):
@@ -396,11 +1092,21 @@ def generate_user_id(length=16):
   return ''.join(random.choices(charset, k=length))
 
 
-def ensure_user_directories(user_id):
-  user_dir = DATA_DIR / user_id
+def is_valid_user_id(user_id):
+  # userid 会直接拼进数据目录路径，只接受 generate_user_id 生成的格式（不会与 _archive 或分片目录重名）
+  return isinstance(user_id, str) and USER_ID_PATTERN.fullmatch(user_id) is not None
+
+
+def ensure_user_directories(study, user_id):
+  if not is_valid_user_id(user_id):
+    raise ValueError(f'invalid userid {user_id!r}')
+  user_dir = user_dir_path(study, user_id)
   forms_dir = user_dir / 'forms'
   user_dir.mkdir(parents=True, exist_ok=True)
   forms_dir.mkdir(parents=True, exist_ok=True)
+  if not holds_live_data(user_dir):
+    # 已归档的被试再次访问（例如刷新页面）时先把归档中的数据放回目录
+    restore_archived_user(study, user_id, user_dir)
   return user_dir, forms_dir
 
 
@@ -420,50 +1126,51 @@ def save_user_meta(user_dir, meta):
   return meta_file
 
 
-def load_group_sequence_index():
-  if not GROUP_SEQUENCE_PATH.exists():
+def load_group_sequence_index(study):
+  if not study.group_sequence_path.exists():
     return 0
   try:
-    data = json.loads(GROUP_SEQUENCE_PATH.read_text(encoding='utf-8'))
+    data = json.loads(study.group_sequence_path.read_text(encoding='utf-8'))
   except (json.JSONDecodeError, OSError):
     return 0
   index = data.get('next_index', 0)
   if isinstance(index, int):
-    return index % len(GROUP_KEYS)
+    return index % len(study.settings.group_keys)
   try:
     parsed = int(index)
   except (TypeError, ValueError):
     return 0
-  return parsed % len(GROUP_KEYS)
+  return parsed % len(study.settings.group_keys)
 
 
-def save_group_sequence_index(index):
-  payload = {'next_index': index % len(GROUP_KEYS)}
+def save_group_sequence_index(study, index):
+  payload = {'next_index': index % len(study.settings.group_keys)}
   try:
-    GROUP_SEQUENCE_PATH.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding='utf-8')
+    study.group_sequence_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding='utf-8')
   except OSError:
     pass
 
 
-def assign_group(user_id, user_dir):
+def assign_group(study, user_id, user_dir):
+  settings = study.settings
   group_file = user_dir / 'group.json'
-  if not RETURN_INCOMPLETE_SWITCH_GROUP and group_file.exists():
+  if not settings.return_incomplete_switch_group and group_file.exists():
     try:
       data = json.loads(group_file.read_text(encoding='utf-8'))
       group = data.get('group')
-      if group in GROUP_KEYS:
+      if group in settings.group_keys:
         return group
     except json.JSONDecodeError:
       pass
 
-  index = load_group_sequence_index()
-  group = GROUP_KEYS[index]
+  index = load_group_sequence_index(study)
+  group = settings.group_keys[index % len(settings.group_keys)]
   payload = {
     'group': group,
     'assigned_at': datetime.now(timezone.utc).isoformat(),
   }
   group_file.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding='utf-8')
-  save_group_sequence_index(index + 1)
+  save_group_sequence_index(study, index + 1)
   return group
 
 
@@ -507,15 +1214,23 @@ def mean(values):
   return sum(values) / len(values) if values else None
 
 
-def score_pre2(answers):
-  positive = collect_numeric_values(answers, range(1, 6))
-  negative = collect_numeric_values(answers, range(6, 11))
+AFFECT_SCALES = {
+  'positive_affect': range(1, 6),
+  'negative_affect': range(6, 11),
+}
+
+
+def score_affect(answers, settings):
   return {
-    'positive_affect': mean(positive),
-    'negative_affect': mean(negative),
+    scale: mean(collect_numeric_values(answers, indices))
+    for scale, indices in settings.affect_scales.items()
   }
 
 
+def score_pre2(answers, settings):
+  return score_affect(answers, settings)
+
+
 def score_pre3(answers):
   values = [parse_numeric(value) for value in answers_to_map(answers).values()]
   numeric_values = [value for value in values if value is not None]
@@ -540,38 +1255,41 @@ POST1_DIMENSIONS = {
 }
 
 
-def score_post1(answers):
+def score_post1(answers, settings):
   results = {}
-  for dimension, indices in POST1_DIMENSIONS.items():
+  for dimension, indices in settings.post1_dimensions.items():
     values = collect_numeric_values(answers, indices)
     results[dimension] = mean(values)
   return results
 
 
-def score_post3(answers):
-  positive = collect_numeric_values(answers, range(1, 6))
-  negative = collect_numeric_values(answers, range(6, 11))
-  return {
-    'positive_affect': mean(positive),
-    'negative_affect': mean(negative),
-  }
+def score_post2(answers):
+  mapped = {}
+  for index, value in answers_to_map(answers).items():
+    numeric = parse_numeric(value)
+    mapped[str(index)] = numeric if numeric is not None else value
+  return {'scores': mapped}
 
 
-def score_post4(answers):
-  ability = collect_numeric_values(answers, range(1, 6))
-  benevolence = collect_numeric_values(answers, range(6, 9))
-  integrity = collect_numeric_values(answers, range(9, 12))
-  ability_score = mean(ability)
-  benevolence_score = mean(benevolence)
-  integrity_score = mean(integrity)
-  overall_components = [score for score in (ability_score, benevolence_score, integrity_score) if score is not None]
-  overall = mean(overall_components)
-  return {
-    'ability_trust': ability_score,
-    'benevolence_trust': benevolence_score,
-    'integrity_trust': integrity_score,
-    'overall_trust': overall,
+def score_post3(answers, settings):
+  return score_affect(answers, settings)
+
+
+POST4_SUBSCALES = {
+  'ability_trust': range(1, 6),
+  'benevolence_trust': range(6, 9),
+  'integrity_trust': range(9, 12),
+}
+
+
+def score_post4(answers, settings):
+  results = {
+    subscale: mean(collect_numeric_values(answers, indices))
+    for subscale, indices in settings.post4_subscales.items()
   }
+  overall_components = [score for score in results.values() if score is not None]
+  results['overall_trust'] = mean(overall_components)
+  return results
 
 
 def score_average(answers):
@@ -607,20 +1325,29 @@ def extract_letter(choice):
   return None
 
 
-def score_post61(answers):
+def selected_letters(selections):
+  if not isinstance(selections, list):
+    selections = selections or []
+    selections = [selections]
+  letters = set()
+  for choice in selections:
+    letter = extract_letter(choice)
+    if letter:
+      letters.add(letter)
+  return letters
+
+
+def score_post61(answers, settings):
+  return grade_post61(answers, settings.post61_correct)
+
+
+def grade_post61(answers, correct):
   score = 0
   details = []
-  for index, expected in POST61_CORRECT.items():
+  for index, expected in correct.items():
     entry = next((item for item in answers if isinstance(item, dict) and (item.get('index') or 0) == index), None)
     selections = entry.get('selected_choice') if isinstance(entry, dict) else None
-    if not isinstance(selections, list):
-      selections = selections or []
-      selections = [selections]
-    letters = set()
-    for choice in selections:
-      letter = extract_letter(choice)
-      if letter:
-        letters.add(letter)
+    letters = selected_letters(selections)
     is_correct = letters == expected
     if is_correct:
       score += 1
@@ -632,42 +1359,748 @@ def score_post61(answers):
     })
   return {
     'total_score': score,
-    'max_score': len(POST61_CORRECT),
+    'max_score': len(correct),
     'details': details,
   }
 
-def score_form(form_key, payload):
+def score_form(form_key, payload, settings):
   answers = payload.get('answers') if isinstance(payload, dict) else None
   if not answers:
     return None
 
   if form_key == 'pre2':
-    return score_pre2(answers)
+    return score_pre2(answers, settings)
   if form_key == 'pre3':
     return score_pre3(answers)
   if form_key == 'pre4':
     return score_pre4(answers)
   if form_key == 'post1':
-    return score_post1(answers)
+    return score_post1(answers, settings)
   if form_key == 'post2':
-    mapped = {}
-    for index, value in answers_to_map(answers).items():
-      numeric = parse_numeric(value)
-      mapped[str(index)] = numeric if numeric is not None else value
-    return {'scores': mapped}
+    return score_post2(answers)
   if form_key == 'post3':
-    return score_post3(answers)
+    return score_post3(answers, settings)
   if form_key == 'post4':
-    return score_post4(answers)
+    return score_post4(answers, settings)
   if form_key == 'post5':
     return score_average(answers)
   if form_key == 'post6_1':
-    return score_post61(answers)
+    return score_post61(answers, settings)
   if form_key == 'post6_2':
     return None  # post6_2 now stores raw answers without automated scoring
   return None
 
 
+def parse_index_range(value, name):
+  if (
+    isinstance(value, list)
+    and len(value) == 2
+    and all(isinstance(bound, int) for bound in value)
+    and 1 <= value[0] <= value[1]
+  ):
+    return range(value[0], value[1] + 1)
+  raise ValueError(f'{name} must be [first_index, last_index]')
+
+
+def parse_scales(value, name, default):
+  if value is None:
+    return dict(default)
+  if not isinstance(value, dict) or not value:
+    raise ValueError(f'{name} must be a non-empty object')
+  return {key: parse_index_range(bounds, f'{name}.{key}') for key, bounds in value.items()}
+
+
+class Settings:
+  # config.json 中的实验设置；重新加载时整体重建后替换
+  def __init__(self, config=None):
+    config = config or {}
+    if not isinstance(config, dict):
+      raise ValueError('config must be a JSON object')
+    scoring = config.get('scoring') or {}
+    if not isinstance(scoring, dict):
+      raise ValueError('scoring must be a JSON object')
+
+    self.return_incomplete_switch_group = bool(
+      config.get('return_incomplete_switch_group', RETURN_INCOMPLETE_SWITCH_GROUP)
+    )
+    group_keys = config.get('group_keys', GROUP_KEYS)
+    if not isinstance(group_keys, (list, tuple)) or not group_keys or not all(isinstance(key, str) for key in group_keys):
+      raise ValueError('group_keys must be a non-empty list of strings')
+    self.group_keys = tuple(group_keys)
+    required_form_files = config.get('required_form_files', REQUIRED_FORM_FILES)
+    if not isinstance(required_form_files, list) or not all(isinstance(name, str) for name in required_form_files):
+      raise ValueError('required_form_files must be a list of file names')
+    self.required_form_files = tuple(required_form_files)
+
+    self.post1_dimensions = parse_scales(scoring.get('post1_dimensions'), 'scoring.post1_dimensions', POST1_DIMENSIONS)
+    self.affect_scales = parse_scales(scoring.get('affect_scales'), 'scoring.affect_scales', AFFECT_SCALES)
+    self.post4_subscales = parse_scales(scoring.get('post4_subscales'), 'scoring.post4_subscales', POST4_SUBSCALES)
+    post61_correct = scoring.get('post61_correct')
+    if post61_correct is None:
+      self.post61_correct = {index: set(letters) for index, letters in POST61_CORRECT.items()}
+    elif isinstance(post61_correct, dict) and post61_correct:
+      try:
+        self.post61_correct = {
+          int(index): {str(letter).upper() for letter in letters}
+          for index, letters in sorted(post61_correct.items(), key=lambda item: int(item[0]))
+        }
+      except (TypeError, ValueError) as error:
+        raise ValueError('scoring.post61_correct must map question index to a list of letters') from error
+    else:
+      raise ValueError('scoring.post61_correct must be a non-empty object')
+
+
+def load_settings(path):
+  if not path.exists():
+    return Settings()
+  try:
+    config = json.loads(path.read_text(encoding='utf-8'))
+  except json.JSONDecodeError as error:
+    raise ValueError(f'{path.name}: {error}') from error
+  return Settings(config)
+
+
+ITEM_ANALYSIS_FORMS = ('pre2', 'post1', 'post3', 'post4', 'post6_1')
+
+
+def collect_item_answers(read_json):
+  answers = {}
+  for form_key in ITEM_ANALYSIS_FORMS:
+    record = read_json(f'forms/{form_key}.json')
+    if record is not None:
+      answers[form_key] = form_answer_map(record)
+  return answers
+
+
+def load_item_answers(study):
+  archive_index = archived_user_index(study)
+  item_answers = {}
+  for user_id, user_dir in iter_user_dirs(study):
+    if user_id in archive_index and not holds_live_data(user_dir):
+      continue
+    item_answers[user_id] = collect_item_answers(live_user_reader(user_dir))
+  for entry in iter_archived_entries(study, item_answers):
+    item_answers[entry['userid']] = entry['answers']
+  return item_answers
+
+
+def record_item_answers(study, user_id, form_key, payload):
+  study.data_version += 1
+  if study.item_answers is None or form_key not in ITEM_ANALYSIS_FORMS:
+    return
+  answers = payload.get('answers') if isinstance(payload, dict) else None
+  study.item_answers.setdefault(user_id, {})[form_key] = answers_to_map(answers)
+
+
+def form_items(form_key, indices):
+  # 计分表的题号范围可能超出问卷实际题数（如 affect_scales 的 6-10 用于只有 8 题的 pre2/post3），只分析存在的题目
+  existing = dict(FORM_QUESTION_INDICES).get(form_key)
+  return tuple(index for index in indices if existing is None or index in existing)
+
+
+def item_analysis_scales(settings):
+  scales = []
+  for form_key in ('pre2', 'post3'):
+    for name, indices in settings.affect_scales.items():
+      scales.append((f'{form_key}-{name}', form_key, form_items(form_key, indices)))
+  for name, indices in settings.post1_dimensions.items():
+    scales.append((f'post1-{name}', 'post1', form_items('post1', indices)))
+  for name, indices in settings.post4_subscales.items():
+    scales.append((f'post4-{name}', 'post4', form_items('post4', indices)))
+  trust_items = sorted({index for indices in settings.post4_subscales.values() for index in indices})
+  scales.append(('post4-overall_trust', 'post4', form_items('post4', trust_items)))
+  return [scale for scale in scales if scale[2]]
+
+
+def form_item_matrix(item_answers, form_key, indices, value_of):
+  rows = [
+    [value_of(index, answers[form_key].get(index)) for index in indices]
+    for answers in item_answers.values()
+    if form_key in answers
+  ]
+  return rows
+
+
+def run_item_analysis(study):
+  settings = study.settings
+  cache_key = (study.data_version, id(settings))
+  if study.item_analysis_cache and study.item_analysis_cache[0] == cache_key:
+    return study.item_analysis_cache[1]
+  if study.item_answers is None:
+    study.item_answers = load_item_answers(study)
+
+  def likert_value(index, value):
+    numeric = parse_numeric(value)
+    return math.nan if numeric is None else numeric
+
+  def knowledge_value(index, value):
+    if value is None or value == [] or value == '':
+      return math.nan
+    return 1.0 if selected_letters(value) == settings.post61_correct[index] else 0.0
+
+  scales = {}
+  for name, form_key, indices in item_analysis_scales(settings):
+    rows = form_item_matrix(study.item_answers, form_key, indices, likert_value)
+    scales[name] = item_analysis.analyze_scale(rows, [f'{form_key}-q{index}' for index in indices])
+  knowledge_indices = form_items('post6_1', settings.post61_correct)
+  rows = form_item_matrix(study.item_answers, 'post6_1', knowledge_indices, knowledge_value)
+  scales['post6_1-knowledge'] = item_analysis.analyze_scale(
+    rows,
+    [f'post6_1-q{index}' for index in knowledge_indices],
+    binary=True,
+  )
+
+  result = {
+    'study': study.name,
+    'data_version': study.data_version,
+    'participants': len(study.item_answers),
+    'generated_at': datetime.now(timezone.utc).isoformat(),
+    'scales': scales,
+  }
+  study.item_analysis_cache = (cache_key, result)
+  return result
+
+
+def validate_lesson_content(content):
+  if not isinstance(content, dict):
+    raise ValueError('lesson must be a JSON object')
+  parts = content.get('parts')
+  if not isinstance(parts, list) or not parts:
+    raise ValueError('lesson.parts must be a non-empty list')
+  for part_index, part in enumerate(parts, start=1):
+    steps = part.get('steps') if isinstance(part, dict) else None
+    if not isinstance(steps, list):
+      raise ValueError(f'lesson.parts[{part_index}].steps must be a list')
+    for step_index, step in enumerate(steps, start=1):
+      if not isinstance(step, dict) or not step.get('type'):
+        raise ValueError(f'lesson.parts[{part_index}].steps[{step_index}] has no type')
+
+
+def validate_form_content(content):
+  if not isinstance(content, dict):
+    raise ValueError('form must be a JSON object')
+  fields = content.get('fields')
+  if not isinstance(fields, list) or not fields:
+    raise ValueError('form.fields must be a non-empty list')
+  for position, field in enumerate(fields, start=1):
+    if not isinstance(field, dict) or not field.get('type'):
+      raise ValueError(f'form.fields[{position}] has no type')
+    if 'index' in field and not isinstance(field['index'], int):
+      raise ValueError(f'form.fields[{position}].index must be an integer')
+
+
+class ContentEntry:
+  __slots__ = ('body', 'gzip_body', 'etag')
+
+  def __init__(self, body):
+    self.body = body
+    self.gzip_body = gzip.compress(body, compresslevel=9, mtime=0)
+    self.etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+
+
+class ContentStore:
+  # 课程脚本和问卷，每次文件变化时校验并预先编码
+  def __init__(self, lesson_dir, form_dir):
+    self.lesson_dir = lesson_dir
+    self.form_dir = form_dir
+    self.lessons = {}
+    self.forms = {}
+    self.version = 0
+    self._signature = None
+    self._next_check = 0.0
+    self._reload_lock = threading.Lock()
+
+  def _file_signature(self):
+    signature = []
+    for directory in (self.lesson_dir, self.form_dir):
+      if not directory.exists():
+        continue
+      for path in sorted(directory.glob('*.json')):
+        try:
+          stat = path.stat()
+        except OSError:
+          continue
+        signature.append((str(path), stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+  def _load_directory(self, directory, validate, key_for):
+    entries = {}
+    for path in sorted(directory.glob('*.json')) if directory.exists() else ():
+      content = json.loads(path.read_text(encoding='utf-8'))
+      try:
+        validate(content)
+      except ValueError as error:
+        raise ValueError(f'{path.name}: {error}') from error
+      key = key_for(path, content)
+      if key in entries:
+        raise ValueError(f'{path.name}: duplicate key {key}')
+      body = json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+      entries[key] = ContentEntry(body)
+    return entries
+
+  def reload(self):
+    signature = self._file_signature()
+    lessons = self._load_directory(self.lesson_dir, validate_lesson_content, lambda path, _: path.stem)
+    forms = self._load_directory(
+      self.form_dir,
+      validate_form_content,
+      lambda path, content: content.get('form_key') or path.stem,
+    )
+    self.lessons, self.forms = lessons, forms
+    self._signature = signature
+    self.version += 1
+    logger.info(f'Loaded content v{self.version}: {len(lessons)} lessons, {len(forms)} forms')
+
+  def maybe_reload(self):
+    now = time.monotonic()
+    if now < self._next_check or not self._reload_lock.acquire(blocking=False):
+      return
+    try:
+      self._next_check = now + CONTENT_RELOAD_CHECK_SECONDS
+      signature = self._file_signature()
+      if signature == self._signature:
+        return
+      try:
+        self.reload()
+      except (OSError, ValueError) as error:
+        # 新文件有问题时继续使用上一版内容，文件再次改动后再重试
+        self._signature = signature
+        logger.error(f'Content reload failed, keeping v{self.version}: {error}')
+    finally:
+      self._reload_lock.release()
+
+  def lookup(self, kind, key):
+    self.maybe_reload()
+    entries = self.lessons if kind == 'lesson' else self.forms
+    return entries.get(key)
+
+
+_content_stores = {}
+
+
+def shared_content_store(content_dir):
+  # 多个实验使用同一份课程/问卷时共用一个缓存
+  content_dir = Path(content_dir).resolve()
+  store = _content_stores.get(content_dir)
+  if store is None:
+    store = ContentStore(content_dir / 'lesson', content_dir / 'forms')
+    try:
+      store.reload()
+    except (OSError, ValueError) as error:
+      logger.error(f'Content load from {content_dir} failed: {error}')
+    _content_stores[content_dir] = store
+  return store
+
+
+class ProgressTracker:
+  # 内存中的实验进度计数，以事件推送给 /progress 的订阅者
+  def __init__(self, group_keys=(), history_size=PROGRESS_HISTORY_SIZE):
+    self._condition = threading.Condition()
+    self._sequence = 0
+    self._events = deque(maxlen=history_size)
+    self.started_at = datetime.now(timezone.utc).isoformat()
+    self.registrations = 0
+    self.groups = {group: 0 for group in group_keys}
+    self.forms = {}
+    self.lessons_completed = 0
+    self.completions = 0
+    self.seeded = False
+    self.closed = False
+
+  def seed(self, registrations, groups, forms, lessons_completed, completions):
+    # 计数都是被试人数：启动时按数据目录中的被试设置初始值，之后只在被试状态变化时增减
+    with self._condition:
+      self.registrations = registrations
+      self.groups = dict(self.groups, **groups)
+      self.forms = dict(forms)
+      self.lessons_completed = lessons_completed
+      self.completions = completions
+      self.seeded = True
+
+  def close(self):
+    with self._condition:
+      self.closed = True
+      self._condition.notify_all()
+
+  def snapshot(self):
+    with self._condition:
+      return self._sequence, self._snapshot_locked()
+
+  def _snapshot_locked(self):
+    return {
+      'started_at': self.started_at,
+      'seeded_from_data': self.seeded,
+      'registrations': self.registrations,
+      'groups': dict(self.groups),
+      'forms': dict(self.forms),
+      'lessons_completed': self.lessons_completed,
+      'completions': self.completions,
+    }
+
+  def _publish_locked(self, event_type, data):
+    self._sequence += 1
+    self._events.append((self._sequence, event_type, data))
+    self._condition.notify_all()
+
+  def record_register(self):
+    with self._condition:
+      self.registrations += 1
+      self._publish_locked('register', {'registrations': self.registrations})
+
+  def record_group(self, group, previous_group=None):
+    # 重复请求分组不重复计数；return_incomplete_switch_group 换组时从原来的组移出
+    with self._condition:
+      if group != previous_group:
+        if previous_group in self.groups:
+          self.groups[previous_group] = max(self.groups[previous_group] - 1, 0)
+        self.groups[group] = self.groups.get(group, 0) + 1
+      self._publish_locked('group', {'group': group, 'count': self.groups[group]})
+
+  def record_form(self, form_key, first_submission):
+    with self._condition:
+      if first_submission:
+        self.forms[form_key] = self.forms.get(form_key, 0) + 1
+      self._publish_locked('form', {'form_key': form_key, 'count': self.forms.get(form_key, 0)})
+
+  def record_lesson_complete(self, first_completion):
+    with self._condition:
+      if first_completion:
+        self.lessons_completed += 1
+      self._publish_locked('lesson', {'lessons_completed': self.lessons_completed})
+
+  def record_completion(self, completed, was_completed):
+    with self._condition:
+      if completed != was_completed:
+        self.completions = max(self.completions + (1 if completed else -1), 0)
+      self._publish_locked('completion', {'completed': completed, 'completions': self.completions})
+
+  def wait_for_events(self, after_sequence, timeout):
+    # 返回 after_sequence 之后的事件；这些事件已超出历史记录时返回 None
+    with self._condition:
+      if self._sequence <= after_sequence and not self.closed:
+        self._condition.wait(timeout)
+      if self._sequence <= after_sequence:
+        return []
+      oldest = self._events[0][0] if self._events else self._sequence + 1
+      if after_sequence + 1 < oldest:
+        return None
+      return [event for event in self._events if event[0] > after_sequence]
+
+
+class StorageLock:
+  # 可重入锁，同时持有数据目录下的文件锁
+  # SIGUSR2 交接期间新旧进程同时处理请求，文件锁让两个进程的分组轮换和 user_record.tsv 更新互斥
+  def __init__(self, lock_path):
+    self.lock_path = lock_path
+    self._lock = threading.RLock()
+    self._depth = 0
+    self._handle = None
+
+  def __enter__(self):
+    self._lock.acquire()
+    if self._depth == 0 and fcntl is not None:
+      try:
+        if self._handle is None:
+          self._handle = self.lock_path.open('a')
+        fcntl.flock(self._handle.fileno(), fcntl.LOCK_EX)
+      except OSError as error:
+        logger.error(f'Locking {self.lock_path} failed: {error}')
+    self._depth += 1
+    return self
+
+  def __exit__(self, *exc_info):
+    self._depth -= 1
+    if self._depth == 0 and self._handle is not None:
+      try:
+        fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+      except OSError:
+        pass
+    self._lock.release()
+    return False
+
+
+class Study:
+  # 本进程承载的一个实验：URL 前缀、数据目录、设置、内容和进度计数
+  def __init__(self, name, prefix='', data_dir=DATA_DIR, config_path=CONFIG_PATH, content_dir=CONTENT_DIR):
+    self.name = name
+    self.prefix = prefix.rstrip('/')
+    self.data_dir = Path(data_dir).resolve()
+    self.user_record_path = self.data_dir / 'user_record.tsv'
+    self.group_sequence_path = self.data_dir / 'group_sequence.json'
+    self.archive_dir = self.data_dir / '_archive'
+    self.config_path = Path(config_path)
+    self.content_dir = Path(content_dir)
+    self.data_dir.mkdir(parents=True, exist_ok=True)
+    self.archive_dir.mkdir(exist_ok=True)
+    try:
+      self.settings = load_settings(self.config_path)
+    except (OSError, ValueError) as error:
+      logger.error(f'[{name}] Config load failed, using defaults: {error}')
+      self.settings = Settings()
+    self.content = shared_content_store(content_dir)
+    self.progress = ProgressTracker(self.settings.group_keys)
+    # 处理请求和归档清理都要持有这把锁，避免归档时目录被同时写入；交接期间也在两个进程间互斥
+    self.storage_lock = StorageLock(self.data_dir / '_storage.lock')
+    self.archive_index_cache = None
+    # 题目分析用的作答数据：首次请求时从磁盘加载，之后随提交更新
+    self.item_answers = None
+    self.data_version = 0
+    self.item_analysis_cache = None
+
+  def reload_settings(self):
+    try:
+      settings = load_settings(self.config_path)
+    except (OSError, ValueError) as error:
+      logger.error(f'[{self.name}] Config reload failed, keeping previous settings: {error}')
+      return False
+    self.settings = settings
+    logger.info(f'[{self.name}] Config reloaded from {self.config_path}: groups={list(settings.group_keys)}')
+    return True
+
+
+def load_studies(path=None):
+  path = STUDIES_PATH if path is None else path
+  if not path.exists():
+    return [Study('default')]
+  try:
+    config = json.loads(path.read_text(encoding='utf-8'))
+  except json.JSONDecodeError as error:
+    raise ValueError(f'{path.name}: {error}') from error
+  entries = config.get('studies') if isinstance(config, dict) else None
+  if not isinstance(entries, list) or not entries:
+    raise ValueError(f'{path.name}: studies must be a non-empty list')
+
+  studies = []
+  for entry in entries:
+    if not isinstance(entry, dict) or not entry.get('name'):
+      raise ValueError(f'{path.name}: every study needs a name')
+    name = entry['name']
+    prefix = entry.get('prefix', f'/{name}')
+    if prefix and not prefix.startswith('/'):
+      raise ValueError(f'{path.name}: prefix of {name} must start with /')
+    studies.append(Study(
+      name,
+      prefix,
+      BASE_DIR / entry.get('data_dir', f'data-{name}'),
+      BASE_DIR / entry.get('config', f'config-{name}.json'),
+      BASE_DIR / entry['content_dir'] if entry.get('content_dir') else CONTENT_DIR,
+    ))
+  for field in ('name', 'prefix', 'data_dir'):
+    values = [getattr(study, field) for study in studies]
+    if len(set(values)) != len(values):
+      raise ValueError(f'{path.name}: study {field} values must be unique')
+  return studies
+
+
+STUDIES = load_studies()
+# 最长前缀优先匹配
+STUDIES_BY_PREFIX = sorted(STUDIES, key=lambda study: len(study.prefix), reverse=True)
+
+
+def find_study(path):
+  for study in STUDIES_BY_PREFIX:
+    if not study.prefix:
+      return study, path
+    if path == study.prefix or path.startswith(study.prefix + '/'):
+      return study, path[len(study.prefix):] or '/'
+  return None, path
+
+
+def profile_label(func):
+  filename, line, name = func
+  if filename == '~':
+    return name
+  return f'{Path(filename).name}:{line}({name})'
+
+
+def folded_stacks(stats):
+  # 根据 pstats.Stats 的调用关系近似生成火焰图的调用栈
+  entries = stats.stats
+  callees = {}
+  for func, (_, _, _, _, callers) in entries.items():
+    for caller, caller_stats in callers.items():
+      callees.setdefault(caller, []).append((func, caller_stats[3]))
+  roots = [func for func, entry in entries.items() if not entry[4]]
+  lines = {}
+
+  def walk(func, inclusive, stack):
+    if inclusive <= 0:
+      return
+    stack = stack + [profile_label(func)]
+    total = entries[func][3] if func in entries else 0
+    scale = inclusive / total if total else 0
+    children_time = 0.0
+    if len(stack) < PROFILE_FLAME_MAX_DEPTH:
+      for callee, edge_time in callees.get(func, ()):
+        if profile_label(callee) in stack:
+          continue
+        child_time = edge_time * scale
+        children_time += child_time
+        walk(callee, child_time, stack)
+    self_time = inclusive - children_time
+    if self_time > 0:
+      key = ';'.join(stack)
+      lines[key] = lines.get(key, 0.0) + self_time
+
+  for root in roots:
+    walk(root, entries[root][3], [])
+  return [f'{key} {round(value * 1_000_000)}' for key, value in sorted(lines.items()) if value >= 1e-6]
+
+
+class RequestProfiler:
+  # 用 cProfile 对部分请求采样；rate 为 0 时只做一次属性检查
+  def __init__(self, output_dir):
+    self.output_dir = output_dir
+    self.rate = 0.0
+    self.until = 0.0
+    self._lock = threading.Lock()
+    self._aggregates = {}
+    self._counts = {}
+    self._dumps = None
+    self._summary_dirty = False
+
+  def configure(self, rate, duration_seconds=0):
+    rate = min(max(float(rate), 0.0), 1.0)
+    duration_seconds = max(float(duration_seconds or 0), 0.0)
+    with self._lock:
+      self.until = time.time() + duration_seconds if rate and duration_seconds else 0.0
+      self.rate = rate
+      if rate and self._dumps is None:
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        # 文件名以时间戳开头，按名称排序即按时间排序
+        self._dumps = deque(sorted(self.output_dir.glob('*.pstats')))
+    if rate:
+      logger.info(f'Request profiling enabled: rate={rate} duration={duration_seconds or "unlimited"}s')
+    else:
+      logger.info('Request profiling disabled')
+      self.flush_summary()
+
+  def status(self):
+    return {
+      'rate': self.rate,
+      'until': datetime.fromtimestamp(self.until, timezone.utc).isoformat() if self.until else None,
+      'profiled_requests': dict(self._counts),
+      'output_dir': str(self.output_dir),
+    }
+
+  def should_profile(self):
+    if self.until and time.time() >= self.until:
+      self.configure(0)
+      return False
+    return random.random() < self.rate
+
+  def profile_call(self, label, func, *args):
+    profile = cProfile.Profile()
+    try:
+      profile.enable()
+    except ValueError:
+      # 同一时刻只能有一个 profiler 生效（其他线程正在采样）
+      func(*args)
+      return
+    started = time.perf_counter()
+    try:
+      func(*args)
+    finally:
+      profile.disable()
+      elapsed = time.perf_counter() - started
+      try:
+        self.record(label, profile, elapsed)
+      except OSError as error:
+        logger.error(f'Writing profile for {label} failed: {error}')
+
+  def record(self, label, profile, elapsed):
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S_%f')
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', label).strip('_')
+    dump_path = self.output_dir / f'{stamp}_{slug}_{round(elapsed * 1000)}ms.pstats'
+    profile.dump_stats(dump_path)
+    stats = pstats.Stats(profile, stream=io.StringIO())
+    with self._lock:
+      if label in self._aggregates:
+        self._aggregates[label].add(stats)
+      else:
+        self._aggregates[label] = stats
+      self._counts[label] = self._counts.get(label, 0) + 1
+      self._summary_dirty = True
+      self._dumps.append(dump_path)
+      while len(self._dumps) > PROFILE_MAX_DUMPS:
+        self._dumps.popleft().unlink(missing_ok=True)
+
+  def flush_summary(self):
+    # 汇总在查询状态或关闭采样时生成，不占用被采样请求的时间
+    with self._lock:
+      if not self._summary_dirty:
+        return
+      try:
+        self.write_summary()
+      except OSError as error:
+        logger.error(f'Writing profile summary failed: {error}')
+        return
+      self._summary_dirty = False
+
+  def write_summary(self):
+    summary = io.StringIO()
+    folded = []
+    for label in sorted(self._aggregates):
+      stats = self._aggregates[label]
+      summary.write(f'===== {label} ({self._counts[label]} requests) =====\n')
+      stats.stream = summary
+      stats.sort_stats('cumulative').print_stats(PROFILE_SUMMARY_TOP)
+      folded.extend(f'{label};{line}' for line in folded_stacks(stats))
+    (self.output_dir / 'summary.txt').write_text(summary.getvalue(), encoding='utf-8')
+    (self.output_dir / 'flame.folded').write_text('\n'.join(folded) + '\n', encoding='utf-8')
+
+
+PROFILER = RequestProfiler(PROFILE_DIR)
+if os.environ.get('PSYCHAT_PROFILE_RATE'):
+  try:
+    PROFILER.configure(os.environ['PSYCHAT_PROFILE_RATE'], os.environ.get('PSYCHAT_PROFILE_SECONDS', 0))
+  except ValueError:
+    logger.error('Invalid PSYCHAT_PROFILE_RATE / PSYCHAT_PROFILE_SECONDS')
+
+
+class RequestCapture:
+  # 只追加的 API 请求记录，JSON lines 格式，每个请求一行
+  def __init__(self, path):
+    self.path = Path(path)
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    self._handle = self.path.open('a', encoding='utf-8')
+    self._lock = threading.Lock()
+
+  def record_seed(self, study):
+    # 分组按 group_sequence.json 轮流分配，记录开始录制时的位置，回放时从同一位置开始
+    entry = {'t': round(time.time(), 6), 'seed': {'study': study.name, 'next_index': load_group_sequence_index(study)}}
+    with self._lock:
+      self._handle.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+      self._handle.flush()
+
+  def record(self, started_at, method, path, body, status, duration, response=None):
+    entry = {
+      't': round(started_at, 6),
+      'm': method,
+      'p': path,
+      'b': body.decode('utf-8', errors='replace') if body else '',
+      's': status,
+      'd': round(duration * 1000, 3),
+    }
+    if response is not None:
+      entry['r'] = response
+    line = json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+    with self._lock:
+      self._handle.write(line + '\n')
+      self._handle.flush()
+
+
+CAPTURE = None
+if CAPTURE_PATH:
+  try:
+    CAPTURE = RequestCapture(CAPTURE_PATH)
+    for capture_study in STUDIES:
+      CAPTURE.record_seed(capture_study)
+    logger.info(f'Capturing requests to {CAPTURE_PATH}')
+  except OSError as error:
+    logger.error(f'Request capture disabled, cannot open {CAPTURE_PATH}: {error}')
+
+
 class RequestHandler(BaseHTTPRequestHandler):
   server_version = 'PsyChatBackend/1.0'
 
@@ -676,7 +2109,7 @@ class RequestHandler(BaseHTTPRequestHandler):
 
   def end_headers(self):
     self.send_header('Access-Control-Allow-Origin', '*')
-    self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+    self.send_header('Access-Control-Allow-Headers', 'Content-Type, If-None-Match, X-Admin-Token')
     self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
     super().end_headers()
 
@@ -685,34 +2118,99 @@ class RequestHandler(BaseHTTPRequestHandler):
     self.end_headers()
 
   def do_POST(self):  # noqa: N802
-    parsed = urlparse(self.path)
-    if parsed.path == '/register':
+    path = urlparse(self.path).path
+    if path == '/admin/profile':
+      self.handle_profile_config()
+      return
+    self.study, self.route_path = find_study(path)
+    if self.study is None:
+      self.send_json(404, {'message': 'Not Found'})
+      return
+    self.dispatch(self.route_post)
+
+  def do_GET(self):  # noqa: N802
+    path = urlparse(self.path).path
+    if path == '/admin/profile':
+      self.handle_profile_status()
+      return
+    self.study, path = find_study(path)
+    self.route_path = path
+    if self.study is None:
+      self.send_json(404, {'message': 'Not Found'})
+    elif path == '/progress':
+      self.handle_progress_stream()
+    elif path.startswith('/lesson/') or path.startswith('/form/'):
+      kind, _, key = path[1:].partition('/')
+      self.dispatch(self.handle_content, kind, key, locked=False)
+    else:
+      self.dispatch(self.route_get)
+
+  def dispatch(self, route, *args, locked=True):
+    if CAPTURE is not None:
+      self.read_raw_body()
+      started_at = time.time()
+      started = time.perf_counter()
+    if PROFILER.rate and PROFILER.should_profile():
+      PROFILER.profile_call(f'{self.command} {urlparse(self.path).path}', self.call_route, route, args, locked)
+    else:
+      self.call_route(route, args, locked)
+    if CAPTURE is not None:
+      try:
+        CAPTURE.record(
+          started_at,
+          self.command,
+          self.path,
+          self.raw_body,
+          getattr(self, 'response_status', None),
+          time.perf_counter() - started,
+          getattr(self, 'captured_response', None),
+        )
+      except OSError as error:
+        logger.error(f'Request capture failed: {error}')
+
+  def call_route(self, route, args, locked):
+    if locked:
+      with self.study.storage_lock:
+        route(*args)
+    else:
+      route(*args)
+
+  def route_post(self):
+    path = self.route_path
+    if path == '/register':
       self.handle_register()
-    elif parsed.path == '/submit-form':
+    elif path == '/submit-form':
       self.handle_submit_form()
-    elif parsed.path == '/lesson-complete':
+    elif path == '/lesson-complete':
       self.handle_lesson_complete()
-    elif parsed.path == '/completion':
+    elif path == '/completion':
       self.handle_completion_post()
     else:
       self.send_json(404, {'message': 'Not Found'})
 
-  def do_GET(self):  # noqa: N802
+  def route_get(self):
     parsed = urlparse(self.path)
-    if parsed.path == '/group':
+    if self.route_path == '/group':
       self.handle_group(parsed)
-    elif parsed.path == '/completion':
+    elif self.route_path == '/completion':
       self.handle_completion_get(parsed)
-    elif parsed.path == '/user-record':
+    elif self.route_path == '/user-record':
       self.handle_user_record_download()
+    elif self.route_path == '/item-analysis':
+      self.handle_item_analysis()
     else:
       self.send_json(404, {'message': 'Not Found'})
 
+  def read_raw_body(self):
+    if not hasattr(self, 'raw_body'):
+      content_length = int(self.headers.get('Content-Length', 0))
+      self.raw_body = self.rfile.read(content_length) if content_length else b''
+    return self.raw_body
+
   def parse_json_body(self):
-    content_length = int(self.headers.get('Content-Length', 0))
-    if content_length == 0:
+    raw_body = self.read_raw_body()
+    if not raw_body:
       return None
-    raw_body = self.rfile.read(content_length)
     try:
       return json.loads(raw_body.decode('utf-8'))
     except json.JSONDecodeError:
@@ -720,13 +2218,15 @@ class RequestHandler(BaseHTTPRequestHandler):
 
   def handle_register(self):
     user_id = generate_user_id()
-    user_dir, _ = ensure_user_directories(user_id)
+    user_dir, _ = ensure_user_directories(self.study, user_id)
     logger.info(f'New user registered: {user_id}')
     meta = load_user_meta(user_dir)
     meta['user_id'] = user_id
     meta['registered_at'] = datetime.now(timezone.utc).isoformat()
     meta.setdefault('completed', False)
     save_user_meta(user_dir, meta)
+    self.study.progress.record_register()
+    self.captured_response = {'userid': user_id}
     self.send_json(200, {'userid': user_id})
 
   def handle_submit_form(self):
@@ -741,18 +2241,23 @@ class RequestHandler(BaseHTTPRequestHandler):
     if not user_id:
       self.send_json(200, {'status': 'success'})
       return
+    if not is_valid_user_id(user_id):
+      self.send_json(400, {'message': 'userid 格式不正确'})
+      return
     logger.info(f'User {user_id} submitted form {form_key}')
-    _, forms_dir = ensure_user_directories(user_id)
+    _, forms_dir = ensure_user_directories(self.study, user_id)
     timestamp = datetime.now(timezone.utc).isoformat()
-    score = score_form(form_key, payload) if form_key != 'pre1' else None
+    score = score_form(form_key, payload, self.study.settings) if form_key != 'pre1' else None
     record = {
       'received_at': timestamp,
       'payload': payload,
     }
     if score is not None:
       record['score'] = score
-    file_path = forms_dir / f'{form_key}.json'
-    file_path.write_text(json.dumps(record, ensure_ascii=False, indent=2), encoding='utf-8')
+    first_submission = not (forms_dir / f'{form_key}{RECORD_SUFFIX}').exists() and not (forms_dir / f'{form_key}.json').exists()
+    write_form_record(forms_dir, form_key, record)
+    record_item_answers(self.study, user_id, form_key, payload)
+    self.study.progress.record_form(form_key, first_submission)
     self.send_json(200, {'status': 'success'})
 
   def handle_lesson_complete(self):
@@ -765,16 +2270,21 @@ class RequestHandler(BaseHTTPRequestHandler):
     if not user_id:
       self.send_json(200, {'status': 'success'})
       return
+    if not is_valid_user_id(user_id):
+      self.send_json(400, {'message': 'userid 格式不正确'})
+      return
     
     logger.info(f'User {user_id} completed lesson')
-    user_dir, _ = ensure_user_directories(user_id)
+    user_dir, _ = ensure_user_directories(self.study, user_id)
     timestamp = datetime.now(timezone.utc).isoformat()
     record = {
       'received_at': timestamp,
       'payload': payload,
     }
     file_path = user_dir / 'lesson.json'
+    first_completion = not file_path.exists()
     file_path.write_text(json.dumps(record, ensure_ascii=False, indent=2), encoding='utf-8')
+    self.study.progress.record_lesson_complete(first_completion)
     self.send_json(200, {'status': 'success'})
 
   def handle_completion_get(self, parsed):
@@ -783,9 +2293,12 @@ class RequestHandler(BaseHTTPRequestHandler):
     if not user_id:
       self.send_json(400, {'message': 'userid 参数不能为空'})
       return
+    if not is_valid_user_id(user_id):
+      self.send_json(400, {'message': 'userid 格式不正确'})
+      return
 
-    user_dir, _ = ensure_user_directories(user_id)
-    if RETURN_INCOMPLETE_SWITCH_GROUP:
+    user_dir, _ = ensure_user_directories(self.study, user_id)
+    if self.study.settings.return_incomplete_switch_group:
       self.send_json(200, {'completed': False})
       logger.info(f'User {user_id} completion status requested: False (incomplete switch mode)')
       return
@@ -805,11 +2318,15 @@ class RequestHandler(BaseHTTPRequestHandler):
     if not user_id:
       self.send_json(400, {'message': 'userid 参数不能为空'})
       return
+    if not is_valid_user_id(user_id):
+      self.send_json(400, {'message': 'userid 格式不正确'})
+      return
 
     logger.info(f'User {user_id} set completion status')
-    user_dir, _ = ensure_user_directories(user_id)
+    user_dir, _ = ensure_user_directories(self.study, user_id)
     meta = load_user_meta(user_dir)
     meta.setdefault('user_id', user_id)
+    was_completed = bool(meta.get('completed'))
     completed_flag = bool(payload.get('completed', True))
     meta['completed'] = completed_flag
     timestamp = datetime.now(timezone.utc).isoformat()
@@ -820,9 +2337,10 @@ class RequestHandler(BaseHTTPRequestHandler):
     meta['status_updated_at'] = timestamp
     save_user_meta(user_dir, meta)
     if completed_flag:
-      row = build_user_record_row(user_id)
+      row = build_user_record_row(self.study, user_id)
       if row:
-        upsert_user_record(row)
+        upsert_user_record(self.study, row)
+    self.study.progress.record_completion(completed_flag, was_completed)
     self.send_json(200, {'status': 'success', 'completed': completed_flag})
 
   def handle_group(self, parsed):
@@ -831,20 +2349,32 @@ class RequestHandler(BaseHTTPRequestHandler):
     if not user_id:
       self.send_json(400, {'message': 'userid 参数不能为空'})
       return
+    if not is_valid_user_id(user_id):
+      self.send_json(400, {'message': 'userid 格式不正确'})
+      return
 
-    user_dir, _ = ensure_user_directories(user_id)
-    group = assign_group(user_id, user_dir)
+    user_dir, _ = ensure_user_directories(self.study, user_id)
+    previous_group = (read_json_file(user_dir / 'group.json') or {}).get('group')
+    group = assign_group(self.study, user_id, user_dir)
     logger.info(f'User {user_id} assigned group: {group}')
+    self.study.progress.record_group(group, previous_group)
+    self.captured_response = {'group': group}
     self.send_json(200, {'group': group})
 
+  def handle_item_analysis(self):
+    if item_analysis is None:
+      self.send_json(503, {'message': '服务器未安装 numpy，无法进行题目分析'})
+      return
+    self.send_json(200, run_item_analysis(self.study))
+
   def handle_user_record_download(self):
-    bootstrap_user_records()
-    if not USER_RECORD_PATH.exists():
+    bootstrap_user_records(self.study)
+    if not self.study.user_record_path.exists():
       self.send_json(404, {'message': '记录文件不存在'})
       return
 
     try:
-      content = USER_RECORD_PATH.read_bytes()
+      content = self.study.user_record_path.read_bytes()
     except OSError:
       self.send_json(500, {'message': '记录文件读取失败'})
       return
@@ -856,6 +2386,100 @@ class RequestHandler(BaseHTTPRequestHandler):
     self.end_headers()
     self.wfile.write(content)
 
+  def check_admin_token(self):
+    if not ADMIN_TOKEN:
+      self.send_json(403, {'message': '未设置 PSYCHAT_ADMIN_TOKEN，管理接口未开放'})
+      return False
+    if not hmac.compare_digest(self.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+      self.send_json(403, {'message': 'Forbidden'})
+      return False
+    return True
+
+  def handle_profile_status(self):
+    if not self.check_admin_token():
+      return
+    PROFILER.flush_summary()
+    self.send_json(200, PROFILER.status())
+
+  def handle_profile_config(self):
+    if not self.check_admin_token():
+      return
+    payload = self.parse_json_body()
+    if not isinstance(payload, dict):
+      self.send_json(400, {'message': '请求体必须是 JSON 对象'})
+      return
+    try:
+      PROFILER.configure(payload.get('rate', 0), payload.get('duration_seconds', 0))
+    except (TypeError, ValueError):
+      self.send_json(400, {'message': 'rate 和 duration_seconds 必须是数字'})
+      return
+    self.send_json(200, PROFILER.status())
+
+  def handle_content(self, kind, key):
+    entry = self.study.content.lookup(kind, key)
+    if entry is None:
+      self.send_json(404, {'message': 'Not Found'})
+      return
+
+    if_none_match = self.headers.get('If-None-Match', '')
+    if entry.etag in (tag.strip().removeprefix('W/') for tag in if_none_match.split(',')):
+      self.send_response(304)
+      self.send_header('ETag', entry.etag)
+      self.send_header('Cache-Control', 'no-cache')
+      self.end_headers()
+      return
+
+    accepts_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+    body = entry.gzip_body if accepts_gzip else entry.body
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('ETag', entry.etag)
+    self.send_header('Cache-Control', 'no-cache')
+    self.send_header('Vary', 'Accept-Encoding')
+    if accepts_gzip:
+      self.send_header('Content-Encoding', 'gzip')
+    self.end_headers()
+    self.wfile.write(body)
+
+  def handle_progress_stream(self):
+    last_event_id = self.headers.get('Last-Event-ID', '')
+    sequence, snapshot = self.study.progress.snapshot()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+    self.send_header('Cache-Control', 'no-cache')
+    self.send_header('X-Accel-Buffering', 'no')
+    self.end_headers()
+    try:
+      after = int(last_event_id) if last_event_id.isdigit() else None
+      # 没有 Last-Event-ID 或者要补发的事件已经不在缓存里时，先发送完整快照
+      if after is None or after > sequence or self.study.progress.wait_for_events(after, 0) is None:
+        self.write_sse_event(sequence, 'snapshot', snapshot)
+        after = sequence
+      while not self.study.progress.closed:
+        events = self.study.progress.wait_for_events(after, PROGRESS_KEEPALIVE_SECONDS)
+        if events is None:
+          after, snapshot = self.study.progress.snapshot()
+          self.write_sse_event(after, 'snapshot', snapshot)
+        elif events:
+          for event_sequence, event_type, data in events:
+            self.write_sse_event(event_sequence, event_type, data)
+            after = event_sequence
+        elif not self.study.progress.closed:
+          self.wfile.write(b': keepalive\n\n')
+          self.wfile.flush()
+    except (BrokenPipeError, ConnectionResetError):
+      return
+
+  def write_sse_event(self, event_id, event_type, data):
+    body = json.dumps(data, ensure_ascii=False)
+    self.wfile.write(f'id: {event_id}\nevent: {event_type}\ndata: {body}\n\n'.encode('utf-8'))
+    self.wfile.flush()
+
+  def send_response(self, code, message=None):
+    self.response_status = code
+    super().send_response(code, message)
+
   def send_json(self, status_code, payload):
     body = json.dumps(payload, ensure_ascii=False)
     encoded = body.encode('utf-8')
@@ -866,17 +2490,335 @@ class RequestHandler(BaseHTTPRequestHandler):
     self.wfile.write(encoded)
 
 
+class BackendServer(ThreadingHTTPServer):
+  # 可以接管继承的监听套接字、关闭时等待进行中请求完成的 ThreadingHTTPServer
+  def __init__(self, server_address, handler_class, listen_fd=None):
+    self._inflight = 0
+    self._inflight_condition = threading.Condition()
+    if listen_fd is None:
+      super().__init__(server_address, handler_class)
+      return
+    super().__init__(server_address, handler_class, bind_and_activate=False)
+    self.socket.close()
+    self.socket = socket.socket(fileno=listen_fd)
+    self.server_address = self.socket.getsockname()
+    host, port = self.server_address[:2]
+    self.server_name = socket.getfqdn(host)
+    self.server_port = port
+
+  def process_request(self, request, client_address):
+    with self._inflight_condition:
+      self._inflight += 1
+    try:
+      super().process_request(request, client_address)
+    except Exception:
+      self._finish_request_tracking()
+      raise
+
+  def process_request_thread(self, request, client_address):
+    try:
+      super().process_request_thread(request, client_address)
+    finally:
+      self._finish_request_tracking()
+
+  def _finish_request_tracking(self):
+    with self._inflight_condition:
+      self._inflight -= 1
+      self._inflight_condition.notify_all()
+
+  def wait_for_drain(self, timeout):
+    deadline = time.monotonic() + timeout
+    with self._inflight_condition:
+      while self._inflight:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          return False
+        self._inflight_condition.wait(remaining)
+    return True
+
+
+def spawn_successor(server):
+  # 新进程继承监听 socket，就绪后向本进程发送 SIGTERM，本进程处理完已有请求再退出
+  listen_fd = server.socket.fileno()
+  env = dict(os.environ, PSYCHAT_LISTEN_FD=str(listen_fd), PSYCHAT_PARENT_PID=str(os.getpid()))
+  try:
+    process = subprocess.Popen(
+      [sys.executable, str(Path(__file__).resolve()), 'serve'],
+      pass_fds=(listen_fd,),
+      env=env,
+      cwd=str(BASE_DIR),
+    )
+  except OSError as error:
+    logger.error(f'Starting successor process failed: {error}')
+    return None
+  logger.info(f'Started successor process {process.pid}')
+  return process
+
+
+def install_signal_handlers(server):
+  successor = []
+
+  def handle_terminate(signum, frame):
+    logger.info('Shutdown requested, draining in-flight requests')
+    # shutdown() 会等待 serve_forever 退出，不能在同一线程中直接调用
+    threading.Thread(target=server.shutdown, name='shutdown', daemon=True).start()
+
+  def handle_reload(signum, frame):
+    for study in STUDIES:
+      study.reload_settings()
+
+  def handle_handoff(signum, frame):
+    if successor and successor[0].poll() is not None:
+      # 上一次启动的新进程已经退出（例如导入出错或 studies.json 有误），允许重新交接
+      logger.error(f'Successor process {successor[0].pid} exited with code {successor[0].returncode}')
+      successor.clear()
+    if successor:
+      logger.warning('Successor process already started, ignoring SIGUSR2')
+      return
+    process = spawn_successor(server)
+    if process is not None:
+      successor.append(process)
+
+  signal.signal(signal.SIGTERM, handle_terminate)
+  if hasattr(signal, 'SIGHUP'):
+    signal.signal(signal.SIGHUP, handle_reload)
+  if hasattr(signal, 'SIGUSR2'):
+    signal.signal(signal.SIGUSR2, handle_handoff)
+
+
 def run():
-  server = HTTPServer((HOST, PORT), RequestHandler)
-  print(f'Backend server running at http://{HOST}:{PORT}')
+  listen_fd = os.environ.pop('PSYCHAT_LISTEN_FD', '')
+  parent_pid = os.environ.pop('PSYCHAT_PARENT_PID', '')
+  for study in STUDIES:
+    # 交接启动的新进程不重建导出：旧进程一直在维护 user_record.tsv，/user-record 下载时也会重建
+    if not parent_pid:
+      bootstrap_user_records(study)
+    seed_progress(study)
+  server = BackendServer((HOST, PORT), RequestHandler, int(listen_fd) if listen_fd else None)
+  host, port = server.server_address[:2]
+  print(f'Backend server running at http://{host}:{port} (pid {os.getpid()})')
+  for study in STUDIES:
+    print(f'  study {study.name}: prefix "{study.prefix or "/"}", data {study.data_dir}')
+  stop_event = threading.Event()
+  if RETENTION_SWEEP_ENABLED:
+    sweeper = threading.Thread(target=run_retention_sweeper, args=(STUDIES, stop_event), name='retention-sweeper', daemon=True)
+    sweeper.start()
+  install_signal_handlers(server)
+  PID_PATH.write_text(str(os.getpid()), encoding='utf-8')
+  if parent_pid:
+    os.kill(int(parent_pid), signal.SIGTERM)
   try:
     server.serve_forever(poll_interval=0.2)
   except KeyboardInterrupt:
     pass
   finally:
+    stop_event.set()
+    for study in STUDIES:
+      study.progress.close()
+    if not server.wait_for_drain(DRAIN_TIMEOUT_SECONDS):
+      logger.warning(f'Requests still running after {DRAIN_TIMEOUT_SECONDS}s, exiting anyway')
     server.server_close()
+    try:
+      if PID_PATH.read_text(encoding='utf-8').strip() == str(os.getpid()):
+        PID_PATH.unlink()
+    except OSError:
+      pass
     print('Backend server stopped')
 
 
-if __name__ == '__main__':
+def percentile(sorted_values, fraction):
+  if not sorted_values:
+    return None
+  position = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+  return sorted_values[position]
+
+
+def read_capture(capture_path):
+  entries = []
+  with Path(capture_path).open('r', encoding='utf-8') as handle:
+    for line_number, line in enumerate(handle, start=1):
+      line = line.strip()
+      if not line:
+        continue
+      try:
+        entries.append(json.loads(line))
+      except json.JSONDecodeError:
+        # 进程被杀时最后一行可能不完整
+        logger.warning(f'Skipping malformed capture line {line_number}')
+  return entries
+
+
+def get_study(name):
+  if name is None:
+    return STUDIES[0]
+  for study in STUDIES:
+    if study.name == name:
+      return study
+  raise SystemExit(f'Unknown study {name}; configured: {", ".join(study.name for study in STUDIES)}')
+
+
+def replay_capture(capture_path, data_dir, speed=1.0, expect_path=None, study_name=None):
+  global CAPTURE, STUDIES, STUDIES_BY_PREFIX, generate_user_id
+  target = Path(data_dir)
+  if target.exists() and any(target.iterdir()):
+    print(f'Replay target {target} must be empty', file=sys.stderr)
+    return 2
+  source = get_study(study_name)
+  captured = read_capture(capture_path)
+  entries = [
+    entry for entry in captured
+    if 'p' in entry and find_study(urlparse(entry['p']).path)[0] is source
+  ]
+  if not entries:
+    print(f'No requests for study {source.name} in {capture_path}', file=sys.stderr)
+    return 2
+  seed = next(
+    (entry['seed'] for entry in captured if isinstance(entry.get('seed'), dict) and entry['seed'].get('study') == source.name),
+    None,
+  )
+
+  study = Study(source.name, source.prefix, target, source.config_path, source.content_dir)
+  if seed is None:
+    print('Capture has no group sequence seed; group assignment starts from the first group', file=sys.stderr)
+  else:
+    # 只用最早的记录：后续进程（重启或交接）记录的位置已包含在回放过程中
+    save_group_sequence_index(study, int(seed.get('next_index') or 0))
+  STUDIES = STUDIES_BY_PREFIX = [study]
+  CAPTURE = None
+  logger.setLevel(logging.WARNING)
+  # 回放时按原始顺序复用当时生成的 userid，保证分组和导出结果可比
+  captured_user_ids = deque(
+    entry['r']['userid'] for entry in entries
+    if find_study(urlparse(entry.get('p', '')).path)[1] == '/register' and isinstance(entry.get('r'), dict)
+  )
+  replayed_user_ids = set(captured_user_ids)
+  random_user_id = generate_user_id
+  generate_user_id = lambda length=16: captured_user_ids.popleft() if captured_user_ids else random_user_id(length)
+
+  server = BackendServer(('127.0.0.1', 0), RequestHandler)
+  thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+  thread.start()
+  connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+  latencies = {}
+  original_latencies = {}
+  status_mismatches = 0
+  response_mismatches = 0
+  first_timestamp = entries[0]['t']
+  replay_started = time.perf_counter()
+  try:
+    for entry in entries:
+      if speed > 0:
+        delay = (entry['t'] - first_timestamp) / speed - (time.perf_counter() - replay_started)
+        if delay > 0:
+          time.sleep(delay)
+      route = f"{entry['m']} {urlparse(entry['p']).path}"
+      body = entry.get('b', '').encode('utf-8')
+      started = time.perf_counter()
+      connection.request(entry['m'], entry['p'], body=body or None, headers={'Content-Type': 'application/json'})
+      response = connection.getresponse()
+      response_body = response.read()
+      latencies.setdefault(route, []).append((time.perf_counter() - started) * 1000)
+      original_latencies.setdefault(route, []).append(entry.get('d', 0))
+      if entry.get('s') is not None and response.status != entry['s']:
+        status_mismatches += 1
+      if 'r' in entry:
+        try:
+          if json.loads(response_body.decode('utf-8')) != entry['r']:
+            response_mismatches += 1
+        except (json.JSONDecodeError, UnicodeDecodeError):
+          response_mismatches += 1
+  finally:
+    connection.close()
+    server.shutdown()
+    server.server_close()
+    generate_user_id = random_user_id
+
+  bootstrap_user_records(study)
+  total_seconds = time.perf_counter() - replay_started
+  print(f'Replayed {len(entries)} requests in {total_seconds:.2f}s (speed={speed or "max"})')
+  print(f'{"route":<28} {"count":>6} {"mean":>9} {"p50":>9} {"p95":>9} {"max":>9} {"orig mean":>10}')
+  for route in sorted(latencies):
+    values = sorted(latencies[route])
+    original = original_latencies[route]
+    print(
+      f'{route:<28} {len(values):>6} {mean(values):>9.2f} {percentile(values, 0.5):>9.2f} '
+      f'{percentile(values, 0.95):>9.2f} {values[-1]:>9.2f} {sum(original) / len(original):>10.2f}'
+    )
+  if status_mismatches:
+    print(f'{status_mismatches} responses had a different status code than captured')
+  if response_mismatches:
+    print(f'{response_mismatches} responses (userid / group) differ from the captured ones')
+
+  produced = study.user_record_path.read_bytes() if study.user_record_path.exists() else b''
+  print(f'user_record.tsv sha256 {hashlib.sha256(produced).hexdigest()}')
+  if expect_path:
+    # 线上导出还包含录制开始前注册的被试，回放中他们只有录制期间的数据；只比较录制期间注册的被试。
+    # 行顺序取决于目录遍历和归档，也不比较
+    produced_lines = produced.decode('utf-8').splitlines()
+    expected_lines = Path(expect_path).read_bytes().decode('utf-8').splitlines()
+    produced_rows = Counter(line for line in produced_lines[1:] if line.split('\t', 1)[0] in replayed_user_ids)
+    expected_rows = Counter(line for line in expected_lines[1:] if line.split('\t', 1)[0] in replayed_user_ids)
+    skipped = len(expected_lines[1:]) - sum(expected_rows.values())
+    if produced_lines[:1] != expected_lines[:1] or produced_rows != expected_rows:
+      print(
+        f'user_record.tsv differs from {expect_path}: '
+        f'header {"matches" if produced_lines[:1] == expected_lines[:1] else "differs"}, '
+        f'{sum((expected_rows - produced_rows).values())} expected rows missing, '
+        f'{sum((produced_rows - expected_rows).values())} unexpected rows'
+      )
+      return 1
+    print(
+      f'user_record.tsv matches {expect_path} for the {sum(expected_rows.values())} participants registered during the capture '
+      f'({skipped} rows of participants registered earlier ignored)'
+    )
+  return 1 if status_mismatches or response_mismatches else 0
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='PsyChat backend')
+  commands = parser.add_subparsers(dest='command')
+  commands.add_parser('serve', help='run the HTTP server (default)')
+  replay_parser = commands.add_parser('replay', help='replay a request capture into a fresh data directory')
+  replay_parser.add_argument('capture', help='file written with PSYCHAT_CAPTURE_PATH')
+  replay_parser.add_argument('--data-dir', required=True, help='empty directory to replay into')
+  replay_parser.add_argument('--speed', type=float, default=1.0, help='1 = original pace, 10 = 10x faster, 0 = no delays')
+  replay_parser.add_argument('--expect', help='user_record.tsv the replay must reproduce')
+  replay_parser.add_argument('--study', help='study whose requests are replayed (default: the first one)')
+  migrate_parser = commands.add_parser('migrate-shards', help='move flat data/<userid> directories into the sharded layout')
+  migrate_parser.add_argument('--study', help='only migrate this study (default: all studies)')
+  migrate_parser.add_argument('--data-dir', help='migrate this data directory instead of a configured study')
+  convert_parser = commands.add_parser('convert-records', help='rewrite stored form records in the compact .rec format (or back to JSON)')
+  convert_parser.add_argument('--study', help='only convert this study (default: all studies)')
+  convert_parser.add_argument('--data-dir', help='convert this data directory instead of a configured study')
+  convert_parser.add_argument('--to', choices=('compact', 'json'), default='compact', help='target format (default: compact)')
+  args = parser.parse_args(argv)
+
+  if args.command == 'replay':
+    return replay_capture(args.capture, args.data_dir, args.speed, args.expect, args.study)
+  if args.command == 'migrate-shards':
+    if args.data_dir:
+      studies = [Study('migrate', data_dir=args.data_dir)]
+    else:
+      studies = [get_study(args.study)] if args.study else STUDIES
+    for study in studies:
+      moved = migrate_to_shards(study)
+      print(f'Moved {moved} user directories into {study.data_dir}')
+    return 0
+  if args.command == 'convert-records':
+    if args.data_dir:
+      studies = [Study('convert', data_dir=args.data_dir)]
+    else:
+      studies = [get_study(args.study)] if args.study else STUDIES
+    for study in studies:
+      summary = convert_user_records(study, args.to)
+      print(
+        f'{study.data_dir}: converted {summary["converted"]} form records to {args.to}, '
+        f'kept {summary["kept"]} that do not fit the compact format, {summary["failed"]} unreadable'
+      )
+    return 0
   run()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
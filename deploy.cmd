@@ -48,6 +48,27 @@ scp back\server.py %USER%@%HOST%:%REMOTE_DIR%/back/server.py || (
     exit /b 1
 )
 
+echo Uploading back/item_analysis.py ...
+scp back\item_analysis.py %USER%@%HOST%:%REMOTE_DIR%/back/item_analysis.py || (
+    echo ERROR: upload of back\item_analysis.py failed.
+    exit /b 1
+)
+
+echo Uploading lesson and form content ...
+ssh %USER%@%HOST% "mkdir -p %REMOTE_DIR%/src/assets" || (
+    echo ERROR: failed to create remote content directory.
+    exit /b 1
+)
+scp -r src\assets\lesson src\assets\forms %USER%@%HOST%:%REMOTE_DIR%/src/assets/ || (
+    echo ERROR: upload of lesson and form content failed.
+    exit /b 1
+)
+
+echo Restarting backend ...
+ssh %USER%@%HOST% "cd %REMOTE_DIR%/back && test -f server.pid && kill -USR2 $(cat server.pid)" || (
+    echo WARNING: no running backend found, start it manually with: python server.py
+)
+
 echo Upload complete.
 endlocal
 exit /b 0
\ No newline at end of file
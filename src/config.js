@@ -8,6 +8,7 @@ export const BACKEND_ENDPOINTS = {
   group: `${API_BASE_URL}/group`,
   lessonComplete: `${API_BASE_URL}/lesson-complete`,
   completion: `${API_BASE_URL}/completion`,
+  lesson: `${API_BASE_URL}/lesson`,
 }
 
 export function getApiBaseUrl() {
@@ -109,3 +109,12 @@ export async function submitLessonSummary(payload, signal) {
 
   return withTimeout(request.then(handleResponse), TIMEOUT_MS)
 }
+
+export async function fetchLesson(group, signal) {
+  const request = fetch(`${BACKEND_ENDPOINTS.lesson}/${encodeURIComponent(group)}`, {
+    method: 'GET',
+    signal,
+  })
+
+  return withTimeout(request.then(handleResponse), TIMEOUT_MS)
+}